@@ -1,10 +1,13 @@
 class Client:
+    __slots__ = ("hostname", "platform", "mac_addr", "ua", "notification_active", "zone")
+
     def __init__(self, ua):
         self.hostname = "unknown"
         self.platform = "unknown"
         self.mac_addr = "unknown"
         self.ua = ua
         self.notification_active = 0
+        self.zone = None
 
     def set_hostname(self, hostname):
         self.hostname = hostname
@@ -15,6 +18,9 @@ class Client:
     def set_mac_addr(self, mac_addr):
         self.mac_addr = mac_addr
 
+    def set_zone(self, zone):
+        self.zone = zone
+
     def is_notification_active(self):
         return self.notification_active != 0
 
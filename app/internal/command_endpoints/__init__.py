@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import time
 
 from pydantic import BaseModel
 
@@ -26,6 +28,30 @@ class CommandEndpointRuntimeException(Exception):
         super().__init__(self.msg)
 
 
+class CommandEndpointTimeoutException(CommandEndpointRuntimeException):
+    """Raised when the command endpoint doesn't respond within the deadline
+
+    Attributes:
+        msg -- error message
+    """
+
+    def __init__(self, msg="Command Endpoint timed out"):
+        super().__init__(msg)
+
+
+class CommandEndpointUnavailableException(CommandEndpointRuntimeException):
+    """Raised when a command could not be sent to the command endpoint at all
+
+    The command never reached the endpoint, so it is safe to send it elsewhere.
+
+    Attributes:
+        msg -- error message
+    """
+
+    def __init__(self, msg="Command Endpoint unavailable"):
+        super().__init__(msg)
+
+
 class CommandEndpointResult(BaseModel):
     ok: bool = False
     speech: str = "Error!"
@@ -45,3 +71,26 @@ class CommandEndpointResponse(BaseModel):
 class CommandEndpoint():
     name = "WAS CommandEndpoint"
     log = logging.getLogger("WAS")
+    # HA entity state cache, only kept by the HA WebSocket endpoint
+    state_cache = None
+
+    async def drain(self, timeout=30):
+        # let requests in flight finish before stopping an endpoint that was replaced
+        deadline = time.monotonic() + timeout
+        while self.inflight() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.inflight() > 0:
+            self.log.warning(f"stopping {self.name} with {self.inflight()} requests in flight")
+        await self.stop()
+
+    def inflight(self):
+        return 0
+
+    async def start(self):
+        pass
+
+    def status(self):
+        return {"name": self.name}
+
+    async def stop(self):
+        pass
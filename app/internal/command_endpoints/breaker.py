@@ -0,0 +1,165 @@
+import asyncio
+import time
+from . import (
+    CommandEndpoint,
+    CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
+    CommandEndpointUnavailableException,
+)
+from enum import Enum
+
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_TIMEOUT = 30
+
+
+class CommandEndpointCircuitOpenException(CommandEndpointUnavailableException):
+    pass
+
+
+class CircuitState(Enum):
+    CLOSED = 1
+    OPEN = 2
+    HALF_OPEN = 3
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.state = CircuitState.CLOSED
+        self.trips = 0
+
+    def allow(self):
+        if self.state == CircuitState.CLOSED:
+            return True
+
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = CircuitState.HALF_OPEN
+
+        # half-open: let a single request through to probe whether the endpoint recovered
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CircuitState.OPEN:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+            self.state = CircuitState.OPEN
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        self.state = CircuitState.CLOSED
+
+    def status(self):
+        return {
+            "failures": self.failures,
+            "state": self.state.name.lower(),
+            "trips": self.trips,
+        }
+
+
+class CircuitBreakerEndpoint(CommandEndpoint):
+    """Wraps a command endpoint with a per-command deadline and a circuit breaker
+
+    When the primary endpoint keeps failing, commands fail fast or go to the optional fallback
+    endpoint until a probe request succeeds again. Only commands that never reached the primary
+    endpoint go to the fallback, a command that timed out or failed after it was sent may well
+    have been executed already.
+    """
+
+    def __init__(self, primary, fallback=None, timeout=BREAKER_TIMEOUT,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = primary.name
+        self.state_cache = primary.state_cache
+        self.timeout = timeout
+
+        self.breakers = {
+            primary: CircuitBreaker(failure_threshold, reset_timeout),
+        }
+        if fallback is not None:
+            self.breakers[fallback] = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def endpoints(self):
+        if self.fallback is None:
+            return [self.primary]
+        return [self.primary, self.fallback]
+
+    def inflight(self):
+        return sum(endpoint.inflight() for endpoint in self.endpoints())
+
+    def parse_response(self, response):
+        # responses are parsed by the endpoint that handled the command
+        return response
+
+    async def start(self):
+        await self.primary.start()
+        if self.fallback is not None:
+            try:
+                await self.fallback.start()
+            except Exception as e:
+                self.log.warning(f"{self.name}: failed to start fallback {self.fallback.name}: {e}")
+                self.fallback = None
+
+    async def call(self, endpoint, jsondata, ws, timeout):
+        breaker = self.breakers[endpoint]
+        if not breaker.allow():
+            raise CommandEndpointCircuitOpenException(f"{endpoint.name}: circuit open")
+
+        try:
+            # endpoints may modify the command, so each one gets its own copy
+            resp = await asyncio.wait_for(endpoint.send(jsondata=dict(jsondata), ws=ws), timeout)
+            if resp is not None:
+                resp = endpoint.parse_response(resp)
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            raise CommandEndpointTimeoutException(f"{endpoint.name}: no response within {timeout:.1f}s")
+        except CommandEndpointRuntimeException:
+            breaker.record_failure()
+            raise
+        except Exception as e:
+            breaker.record_failure()
+            raise CommandEndpointRuntimeException(e)
+
+        breaker.record_success()
+        return resp
+
+    async def send(self, data=None, jsondata=None, ws=None):
+        deadline = time.monotonic() + self.timeout
+        try:
+            return await self.call(self.primary, jsondata, ws, self.timeout)
+        except CommandEndpointUnavailableException as e:
+            remaining = deadline - time.monotonic()
+            if self.fallback is None or remaining <= 0:
+                raise
+            self.log.info(f"{self.name}: {e}, falling back to {self.fallback.name}")
+
+        return await self.call(self.fallback, jsondata, ws, remaining)
+
+    def status(self):
+        status = self.primary.status()
+        status["breaker"] = self.breakers[self.primary].status()
+        status["timeout"] = self.timeout
+        if self.fallback is not None:
+            status["fallback"] = self.fallback.status()
+            status["fallback"]["breaker"] = self.breakers[self.fallback].status()
+        return status
+
+    async def stop(self):
+        for endpoint in self.endpoints():
+            await endpoint.stop()
@@ -0,0 +1,171 @@
+import asyncio
+import httpx
+import time
+from . import (
+    CommandEndpoint,
+    CommandEndpointResponse,
+    CommandEndpointResult,
+)
+from app.internal.multinet import normalize_phrase
+from app.internal.was import construct_url
+
+
+HA_LOCAL_DOMAINS = ["fan", "input_boolean", "light", "switch"]
+HA_LOCAL_REFRESH_INTERVAL = 300
+HA_LOCAL_TIMEOUT = httpx.Timeout(5, connect=1)
+
+
+class HomeAssistantLocalIntentEndpoint(CommandEndpoint):
+    """Handles simple on/off commands by calling Home Assistant services directly
+
+    Commands are matched against an index of "TURN ON/OFF <entity>" phrases built from the
+    entity IDs and friendly names in the HA states. Commands that don't match exactly, or whose
+    service call fails, are passed on to the wrapped endpoint.
+
+    With a state cache the index follows the entities in the cache, otherwise it is refreshed
+    from the HA REST API periodically.
+    """
+
+    def __init__(self, endpoint, host, port, tls, token, state_cache=None,
+                 refresh_interval=HA_LOCAL_REFRESH_INTERVAL):
+        self.endpoint = endpoint
+        self.name = endpoint.name
+        self.refresh_interval = refresh_interval
+        self.token = token
+        self.url = construct_url(host, port, tls)
+
+        self.client = httpx.AsyncClient(timeout=HA_LOCAL_TIMEOUT)
+        self.hits = 0
+        self.index = {}
+        self.index_version = None
+        self.misses = 0
+        self.refreshed_at = None
+        self.state_cache = state_cache
+        self.task = None
+
+    def headers(self):
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    def build_index(self, states):
+        index = {}
+        ambiguous = set()
+        for state in states:
+            domain, _, object_id = state["entity_id"].partition(".")
+            if domain not in HA_LOCAL_DOMAINS:
+                continue
+
+            names = {normalize_phrase(object_id)}
+            friendly_name = state.get("attributes", {}).get("friendly_name")
+            if friendly_name:
+                names.add(normalize_phrase(friendly_name))
+            else:
+                friendly_name = object_id.replace("_", " ")
+
+            for name in names:
+                if not name:
+                    continue
+                for action, service in [("ON", "turn_on"), ("OFF", "turn_off")]:
+                    phrase = f"TURN {action} {name}"
+                    target = (domain, service, state["entity_id"], friendly_name)
+                    # phrases matching more than one entity are left to the conversation agent
+                    if phrase in index and index[phrase] != target:
+                        ambiguous.add(phrase)
+                    index[phrase] = target
+
+        for phrase in ambiguous:
+            index.pop(phrase)
+
+        return index
+
+    def match(self, text):
+        cache = self.state_cache
+        if cache is not None and cache.is_ready() and cache.version != self.index_version:
+            self.index = self.build_index(cache.list())
+            self.index_version = cache.version
+            self.refreshed_at = time.time()
+
+        phrase = normalize_phrase(text)
+        target = self.index.get(phrase)
+        if target is None and phrase.startswith(("TURN ON THE ", "TURN OFF THE ")):
+            target = self.index.get(phrase.replace(" THE ", " ", 1))
+        return target
+
+    async def refresh(self):
+        response = await self.client.get(f"{self.url}/api/states", headers=self.headers())
+        response.raise_for_status()
+        self.index = self.build_index(response.json())
+        self.refreshed_at = time.time()
+        self.log.info(f"{self.name}: {len(self.index)} local intent phrases")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            if self.state_cache is not None and self.state_cache.is_ready():
+                continue
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.warning(f"{self.name}: failed to refresh local intents: {e}")
+
+    def inflight(self):
+        return self.endpoint.inflight()
+
+    def parse_response(self, response):
+        return response
+
+    async def start(self):
+        await self.endpoint.start()
+        # the state cache fills in once the HA WebSocket connection is up
+        if self.state_cache is None:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.log.warning(f"{self.name}: failed to load local intents: {e}")
+        self.task = asyncio.create_task(self.run())
+
+    async def call_service(self, domain, service, entity_id):
+        url = f"{self.url}/api/services/{domain}/{service}"
+        response = await self.client.post(url, headers=self.headers(), json={"entity_id": entity_id})
+        response.raise_for_status()
+
+    async def send(self, data=None, jsondata=None, ws=None):
+        target = None
+        if jsondata is not None and "text" in jsondata:
+            target = self.match(jsondata["text"])
+
+        if target is not None:
+            domain, service, entity_id, friendly_name = target
+            try:
+                await self.call_service(domain, service, entity_id)
+                self.hits += 1
+                self.log.debug(f"{self.name}: handled '{jsondata['text']}' locally: {service} {entity_id}")
+                action = "on" if service == "turn_on" else "off"
+                res = CommandEndpointResult(ok=True, speech=f"Turned {action} {friendly_name}")
+                return CommandEndpointResponse(result=res).model_dump_json()
+            except Exception as e:
+                self.log.warning(f"{self.name}: local intent for {entity_id} failed: {e}")
+
+        self.misses += 1
+        resp = await self.endpoint.send(jsondata=jsondata, ws=ws)
+        if resp is not None:
+            resp = self.endpoint.parse_response(resp)
+        return resp
+
+    def status(self):
+        status = self.endpoint.status()
+        status["local_intents"] = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "phrases": len(self.index),
+            "refreshed_at": self.refreshed_at,
+        }
+        return status
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.client.aclose()
+        await self.endpoint.stop()
@@ -11,7 +11,7 @@ class HomeAssistantRestEndpoint(RestEndpoint):
         self.port = port
         self.token = token
         self.tls = tls
-        self.url = self.construct_url(ws=False)
+        super().__init__(self.construct_url(ws=False))
         self.config = RestConfig(auth_type=RestAuthType.HEADER, auth_header=f"Bearer {token}")
 
     def construct_url(self, ws):
@@ -29,13 +29,13 @@ class HomeAssistantRestEndpoint(RestEndpoint):
 
     def parse_response(self, response):
         res = CommandEndpointResult()
-        if response.ok:
+        if response.is_success:
             res.ok = True
             res.speech = self.get_speech(response.json())
 
         command_endpoint_response = CommandEndpointResponse(result=res)
         return command_endpoint_response.model_dump_json()
 
-    def send(self, data=None, jsondata=None, ws=None):
+    async def send(self, data=None, jsondata=None, ws=None):
         out = {'text': jsondata["text"], 'language': jsondata["language"]}
-        return super().send(jsondata=out)
+        return await super().send(jsondata=out)
@@ -1,6 +1,8 @@
 import asyncio
+import httpx
+import itertools
 import json
-import requests
+import random
 import time
 import websockets
 from . import (
@@ -8,19 +10,27 @@ from . import (
     CommandEndpointResponse,
     CommandEndpointResult,
     CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
+    CommandEndpointUnavailableException,
 )
+from app.internal.ha_state import HomeAssistantStateCache
 
 
-class HomeAssistantWebSocketEndpointNotSupportedException(CommandEndpointRuntimeException):
-    pass
+HA_WS_BACKOFF_MAX = 30
+HA_WS_BACKOFF_MIN = 0.5
+HA_WS_MAX_INFLIGHT = 32
+HA_WS_MAX_QUEUED = 64
+# commands not sent by then go to the fallback endpoint
+HA_WS_QUEUE_TIMEOUT = 5
+HA_WS_TIMEOUT = 30
+HA_WS_WARMUP_TIMEOUT = 5
 
 
 class HomeAssistantWebSocketEndpoint(CommandEndpoint):
     name = "WAS Home Assistant WebSocket Endpoint"
 
-    connmap = {}
-
-    def __init__(self, app, host, port, tls, token):
+    def __init__(self, app, host, port, tls, token, max_inflight=HA_WS_MAX_INFLIGHT, max_queued=HA_WS_MAX_QUEUED,
+                 queue_timeout=HA_WS_QUEUE_TIMEOUT, timeout=HA_WS_TIMEOUT):
         self.app = app
         self.host = host
         self.port = port
@@ -29,19 +39,42 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
         self.url = self.construct_url(ws=True)
 
         self.haws = None
+        self.backoff = 0
+        self.connected_at = None
+        self.max_queued = max_queued
+        self.queued = 0
+        self.queue_timeout = queue_timeout
+        # commands wait here until the connection is authenticated
+        self.ready = asyncio.Event()
+        self.reconnects = 0
+        self.state = "connecting"
+        # HA requires message IDs to increase per connection, never reusing them also means a late
+        # answer on a previous connection can't be mistaken for a new request
+        self.ids = itertools.count(1)
+        self.requests = {}
+        self.slots = asyncio.Semaphore(max_inflight)
+        self.state_cache = HomeAssistantStateCache()
+        self.state_ids = (None, None)
+        self.task = None
+        self.timeout = timeout
 
-        if not self.is_supported():
-            raise HomeAssistantWebSocketEndpointNotSupportedException
+    async def start(self):
+        self.task = asyncio.create_task(self.connect())
 
-        loop = asyncio.get_event_loop()
-        self.task = loop.create_task(self.connect())
+        # give the connection a chance to authenticate before the endpoint is put in use,
+        # commands sent before that are queued anyway
+        try:
+            await asyncio.wait_for(self.ready.wait(), HA_WS_WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log.warning(f"{self.name}: not ready after {HA_WS_WARMUP_TIMEOUT}s, continuing")
 
-    def is_supported(self):
+    async def is_supported(self):
         headers = {}
         headers['Content-Type'] = 'application/json'
         headers['Authorization'] = f"Bearer {self.token}"
         ha_components_url = f"{self.construct_url(False)}/api/components"
-        response = requests.get(ha_components_url, headers=headers)
+        async with httpx.AsyncClient(timeout=httpx.Timeout(10, connect=2)) as client:
+            response = await client.get(ha_components_url, headers=headers)
 
         if "assist_pipeline" in response.json():
             return True
@@ -60,52 +93,147 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
     async def connect(self):
         while True:
             try:
+                self.state = "connecting"
                 # deflate compression is enabled by default, making tcpdump difficult
                 async with websockets.connect(f"{self.url}/api/websocket", compression=None) as self.haws:
+                    self.state = "authenticating"
                     while True:
                         msg = await self.haws.recv()
                         await self.cb_msg(msg)
             except Exception as e:
                 self.log.info(f"{self.name}: exception occurred: {e}")
-                await asyncio.sleep(1)
+
+            self.haws = None
+            self.ready.clear()
+            self.state = "disconnected"
+            self.connected_at = None
+            self.reconnects += 1
+            self.state_cache.invalidate()
+            # requests sent on the old connection will never be answered
+            self.fail_requests("Home Assistant connection lost")
+
+            # jittered exponential backoff so a restarting HA isn't hammered by every WAS at once
+            delay = min(HA_WS_BACKOFF_MAX, HA_WS_BACKOFF_MIN * 2 ** self.backoff)
+            # stop growing the exponent once the cap is reached, 2 ** backoff overflows a float eventually
+            if delay < HA_WS_BACKOFF_MAX:
+                self.backoff += 1
+            delay = random.uniform(delay / 2, delay)
+            self.log.info(f"{self.name}: reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
     async def cb_msg(self, msg):
         self.log.debug(f"haws_cb: {self.app} {msg}")
         msg = json.loads(msg)
         if "type" in msg:
             if msg["type"] == "event":
-                if msg["event"]["type"] == "intent-end":
-                    id = int(msg["id"])
-                    ws = self.connmap[id]
+                event = msg["event"]
+                if msg["id"] == self.state_ids[0]:
+                    if event.get("event_type") == "state_changed":
+                        self.state_cache.apply(event["data"])
+                elif event["type"] == "intent-end":
                     out = CommandEndpointResult()
-                    response_type = msg["event"]["data"]["intent_output"]["response"]["response_type"]
+                    response_type = event["data"]["intent_output"]["response"]["response_type"]
                     if response_type == "action_done":
                         out.ok = True
-                    out.speech = msg["event"]["data"]["intent_output"]["response"]["speech"]["plain"]["speech"]
-                    command_endpoint_response = CommandEndpointResponse(result=out)
-                    self.log.debug(f"sending {command_endpoint_response} to {ws}")
-                    asyncio.ensure_future(ws.send_text(command_endpoint_response.model_dump_json()))
-                    self.connmap.pop(id)
+                    out.speech = event["data"]["intent_output"]["response"]["speech"]["plain"]["speech"]
+                    self.resolve(msg["id"], out)
+                elif event["type"] == "error":
+                    self.resolve(msg["id"], CommandEndpointResult(speech=event["data"]["message"]))
+                elif event["type"] == "run-end":
+                    self.resolve(msg["id"], CommandEndpointResult(speech="Home Assistant pipeline ended without result"))
+            elif msg["type"] == "result":
+                if msg["id"] == self.state_ids[1]:
+                    if msg["success"]:
+                        self.state_cache.load(msg["result"])
+                    else:
+                        self.log.warning(f"{self.name}: failed to get HA states: {msg['error']['message']}")
+                elif not msg["success"]:
+                    self.resolve(msg["id"], CommandEndpointResult(speech=msg["error"]["message"]))
+            elif msg["type"] == "auth_ok":
+                self.log.info(f"{self.name}: authenticated, {self.queued} queued commands")
+                self.state = "ready"
+                self.backoff = 0
+                self.connected_at = time.time()
+                # the state IDs have to be taken and sent before any queued command gets an ID
+                await self.subscribe_states()
+                self.ready.set()
+            elif msg["type"] == "auth_invalid":
+                self.log.error(f"{self.name}: authentication failed: {msg.get('message')}")
+                self.state = "auth_invalid"
             elif msg["type"] == "auth_required":
                 auth_msg = {
                     "type": "auth",
                     "access_token": self.token,
                 }
-                self.log.debug(f"authenticating HA WebSocket connection: {auth_msg}")
+                self.log.debug("authenticating HA WebSocket connection")
                 await self.haws.send(json.dumps(auth_msg))
 
-    def parse_response(self, response):
-        return None
+    async def subscribe_states(self):
+        # subscribe before fetching the snapshot so no state change falls in between
+        self.state_ids = (next(self.ids), next(self.ids))
+        subscribe_msg = {
+            "event_type": "state_changed",
+            "id": self.state_ids[0],
+            "type": "subscribe_events",
+        }
+        get_states_msg = {
+            "id": self.state_ids[1],
+            "type": "get_states",
+        }
+        await self.haws.send(json.dumps(subscribe_msg))
+        await self.haws.send(json.dumps(get_states_msg))
+
+    def resolve(self, id, result):
+        future = self.requests.get(id)
+        if future is None or future.done():
+            return
 
-    def send(self, jsondata, ws):
-        id = int(time.time() * 1000)
+        command_endpoint_response = CommandEndpointResponse(result=result)
+        self.log.debug(f"resolving HA WS request {id}: {command_endpoint_response}")
+        future.set_result(command_endpoint_response.model_dump_json())
 
-        if id not in self.connmap:
-            self.connmap[id] = ws
+    def fail_requests(self, msg):
+        for future in self.requests.values():
+            if not future.done():
+                future.set_exception(CommandEndpointRuntimeException(msg))
+
+    def inflight(self):
+        return len(self.requests) + self.queued
+
+    def parse_response(self, response):
+        return response
+
+    async def send(self, jsondata, ws):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        # the command hasn't been sent until it has a slot, it can go elsewhere until then
+        queue_deadline = loop.time() + min(self.queue_timeout, self.timeout)
 
         if "language" in jsondata:
             jsondata.pop("language")
 
+        # hold commands while (re)connecting, waiting counts towards the deadline
+        if not self.ready.is_set():
+            if self.queued >= self.max_queued:
+                raise CommandEndpointUnavailableException(f"{self.name}: not connected and command queue full")
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.ready.wait(), queue_deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise CommandEndpointUnavailableException(f"{self.name}: not connected")
+            finally:
+                self.queued -= 1
+
+        # bound the number of outstanding requests
+        try:
+            await asyncio.wait_for(self.slots.acquire(), queue_deadline - loop.time())
+        except asyncio.TimeoutError:
+            raise CommandEndpointUnavailableException(f"{self.name}: too many requests in flight")
+
+        id = next(self.ids)
+        future = loop.create_future()
+        self.requests[id] = future
+
         out = {
             'end_stage': 'intent',
             'id': id,
@@ -114,9 +242,33 @@ class HomeAssistantWebSocketEndpoint(CommandEndpoint):
             'type': 'assist_pipeline/run',
         }
 
-        self.log.debug(f"sending to HA WS: {out}")
-        asyncio.ensure_future(self.haws.send(json.dumps(out)))
+        try:
+            self.log.debug(f"sending to HA WS: {out}")
+            await self.haws.send(json.dumps(out))
+            return await asyncio.wait_for(future, deadline - loop.time())
+        except asyncio.TimeoutError:
+            raise CommandEndpointTimeoutException(f"{self.name}: no response for request {id}")
+        except CommandEndpointRuntimeException:
+            raise
+        except Exception as e:
+            raise CommandEndpointRuntimeException(e)
+        finally:
+            self.requests.pop(id, None)
+            self.slots.release()
+
+    def status(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "connected_at": self.connected_at,
+            "inflight": len(self.requests),
+            "queued": self.queued,
+            "reconnects": self.reconnects,
+            "state_cache": self.state_cache.status(),
+        }
 
-    def stop(self):
+    async def stop(self):
         self.log.info(f"stopping {self.name}")
-        self.task.cancel()
+        if self.task is not None:
+            self.task.cancel()
+        self.fail_requests(f"{self.name} stopped")
@@ -1,27 +1,33 @@
+import asyncio
+
 from logging import getLogger
 
+from app.internal.command_endpoints.breaker import CircuitBreakerEndpoint
+from app.internal.command_endpoints.ha_local import HomeAssistantLocalIntentEndpoint
 from app.internal.command_endpoints.ha_rest import HomeAssistantRestEndpoint
-from app.internal.command_endpoints.ha_ws import (
-    HomeAssistantWebSocketEndpoint,
-    HomeAssistantWebSocketEndpointNotSupportedException
-)
+from app.internal.command_endpoints.ha_ws import HomeAssistantWebSocketEndpoint
 from app.internal.command_endpoints.mqtt import MqttConfig, MqttEndpoint
 from app.internal.command_endpoints.openhab import OpenhabEndpoint
 from app.internal.command_endpoints.rest import RestEndpoint
 from app.internal.was import get_config
+from app.settings import get_settings
 
 
 log = getLogger("WAS")
 
+COMMAND_ENDPOINT_RETRY_MAX = 300
+COMMAND_ENDPOINT_RETRY_MIN = 5
+
+init_lock = asyncio.Lock()
+# keep references to endpoints that are draining so their tasks aren't garbage collected
+draining = set()
 
-def init_command_endpoint(app):
-    # call command_endpoint.stop() to avoid leaking asyncio task
-    try:
-        app.command_endpoint.stop()
-    except Exception:
-        pass
 
+async def build_command_endpoint(app):
+    settings = get_settings()
     user_config = get_config()
+    fallback = None
+    state_cache = None
 
     if "was_mode" in user_config and user_config["was_mode"]:
         log.info("WAS Endpoint mode enabled")
@@ -33,10 +39,13 @@ def init_command_endpoint(app):
             tls = user_config["hass_tls"]
             token = user_config["hass_token"]
 
-            try:
-                app.command_endpoint = HomeAssistantWebSocketEndpoint(app, host, port, tls, token)
-            except HomeAssistantWebSocketEndpointNotSupportedException:
-                app.command_endpoint = HomeAssistantRestEndpoint(host, port, tls, token)
+            # the REST API takes over commands while the WebSocket connection is failing
+            command_endpoint = HomeAssistantWebSocketEndpoint(app, host, port, tls, token)
+            if await command_endpoint.is_supported():
+                fallback = HomeAssistantRestEndpoint(host, port, tls, token)
+                state_cache = command_endpoint.state_cache
+            else:
+                command_endpoint = HomeAssistantRestEndpoint(host, port, tls, token)
 
         elif user_config["command_endpoint"] == "MQTT":
             mqtt_config = MqttConfig()
@@ -46,26 +55,92 @@ def init_command_endpoint(app):
             mqtt_config.set_tls(user_config["mqtt_tls"])
             mqtt_config.set_topic(user_config["mqtt_topic"])
 
+            if 'mqtt_qos' in user_config:
+                mqtt_config.set_qos(user_config['mqtt_qos'])
+
+            if 'mqtt_response_topic' in user_config:
+                mqtt_config.set_response_topic(user_config['mqtt_response_topic'])
+
             if 'mqtt_password' in user_config:
                 mqtt_config.set_password(user_config['mqtt_password'])
 
             if 'mqtt_username' in user_config:
                 mqtt_config.set_username(user_config['mqtt_username'])
 
-            app.command_endpoint = MqttEndpoint(mqtt_config)
+            command_endpoint = MqttEndpoint(mqtt_config)
 
         elif user_config["command_endpoint"] == "openHAB":
-            app.command_endpoint = OpenhabEndpoint(user_config["openhab_url"], user_config["openhab_token"])
+            command_endpoint = OpenhabEndpoint(user_config["openhab_url"], user_config["openhab_token"])
 
         elif user_config["command_endpoint"] == "REST":
-            app.command_endpoint = RestEndpoint(user_config["rest_url"])
-            app.command_endpoint.config.set_auth_type(user_config["rest_auth_type"])
+            command_endpoint = RestEndpoint(user_config["rest_url"])
+            command_endpoint.config.set_auth_type(user_config["rest_auth_type"])
 
             if "rest_auth_header" in user_config:
-                app.command_endpoint.config.set_auth_header(user_config["rest_auth_header"])
+                command_endpoint.config.set_auth_header(user_config["rest_auth_header"])
 
             if "rest_auth_pass" in user_config:
-                app.command_endpoint.config.set_auth_pass(user_config["rest_auth_pass"])
+                command_endpoint.config.set_auth_pass(user_config["rest_auth_pass"])
 
             if "rest_auth_user" in user_config:
-                app.command_endpoint.config.set_auth_user(user_config["rest_auth_user"])
+                command_endpoint.config.set_auth_user(user_config["rest_auth_user"])
+
+        else:
+            return None
+
+        command_endpoint = CircuitBreakerEndpoint(
+            command_endpoint,
+            fallback=fallback,
+            timeout=settings.command_endpoint_timeout,
+            failure_threshold=settings.command_endpoint_failure_threshold,
+            reset_timeout=settings.command_endpoint_reset_timeout,
+        )
+
+        # simple on/off commands skip the HA conversation agent
+        if user_config["command_endpoint"] == "Home Assistant" and user_config.get("hass_local_intents", True):
+            command_endpoint = HomeAssistantLocalIntentEndpoint(command_endpoint, host, port, tls, token,
+                                                                state_cache=state_cache)
+
+        try:
+            await command_endpoint.start()
+        except Exception:
+            await command_endpoint.stop()
+            raise
+        return command_endpoint
+
+    return None
+
+
+async def init_command_endpoint(app):
+    # the new endpoint is started before it replaces the old one, which then drains its
+    # requests in flight in the background, so devices always have a working endpoint
+    async with init_lock:
+        command_endpoint = await build_command_endpoint(app)
+        old = getattr(app, "command_endpoint", None)
+        app.command_endpoint = command_endpoint
+        app.ha_state_cache = None if command_endpoint is None else command_endpoint.state_cache
+
+        if old is not None:
+            task = asyncio.create_task(old.drain())
+            draining.add(task)
+            task.add_done_callback(draining.discard)
+
+
+async def retry_command_endpoint(app):
+    # the command endpoint may be unreachable when WAS starts, keep trying until it comes up or
+    # a config change initialized one
+    delay = COMMAND_ENDPOINT_RETRY_MIN
+    while True:
+        await asyncio.sleep(delay)
+        if app.command_endpoint is not None:
+            return
+
+        try:
+            await init_command_endpoint(app)
+        except Exception as e:
+            delay = min(COMMAND_ENDPOINT_RETRY_MAX, delay * 2)
+            log.warning(f"failed to initialize command endpoint, retrying in {delay}s ({e})")
+            continue
+
+        log.info("command endpoint initialized")
+        return
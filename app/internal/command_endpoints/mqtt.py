@@ -2,14 +2,24 @@ import asyncio
 import json
 import logging
 import paho.mqtt.client as mqtt
+import time
 from . import (
     CommandEndpoint,
     CommandEndpointConfigException,
     CommandEndpointResponse,
     CommandEndpointResult,
-    CommandEndpointRuntimeException
+    CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
+    CommandEndpointUnavailableException,
 )
+from collections import deque
 from enum import Enum
+from uuid import uuid4
+
+
+MQTT_QUEUE_SIZE = 100
+MQTT_QUEUE_TTL = 30
+MQTT_TIMEOUT = 10
 
 
 class MqttAuthType(Enum):
@@ -22,6 +32,8 @@ class MqttConfig:
     hostname: str = None
     password: str = None
     port: int = 8883
+    qos: int = 0
+    response_topic: str = None
     tls: bool = True
     topic: str = None
     username: str = None
@@ -41,6 +53,12 @@ class MqttConfig:
     def set_port(self, port=8883):
         self.port = port
 
+    def set_qos(self, qos=0):
+        self.qos = int(qos)
+
+    def set_response_topic(self, response_topic=None):
+        self.response_topic = response_topic or None
+
     def set_tls(self, tls=True):
         self.tls = tls
 
@@ -51,6 +69,11 @@ class MqttConfig:
         self.username = username
 
     def validate(self):
+        if self.qos not in (0, 1, 2):
+            raise CommandEndpointConfigException(f"invalid MQTT QoS {self.qos}")
+        # we'd receive our own commands as responses
+        if self.response_topic is not None and self.response_topic == self.topic:
+            raise CommandEndpointConfigException("MQTT response topic must differ from the command topic")
         if self.auth_type == MqttAuthType.USERPW:
             if self.password is None:
                 raise CommandEndpointConfigException("User/Password auth enabled without password")
@@ -65,17 +88,28 @@ class MqttEndpoint(CommandEndpoint):
         self.config = config
         self.config.validate()
         self.connected = False
+        self.loop = None
         self.mqtt_client = None
+        # correlation ID -> future resolved from the paho network thread
+        self.pending = {}
+        # publishes are buffered here while the broker is unreachable
+        self.queue = deque()
+        self.expired = 0
+        self.latencies = deque(maxlen=100)
+        self.published = 0
+        self.publishing = {}
 
-        loop = asyncio.get_event_loop()
-        self.task = loop.create_task(self.connect())
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        await self.connect()
 
     async def connect(self):
         try:
             self.mqtt_client = mqtt.Client()
             self.mqtt_client.on_connect = self.cb_connect
             self.mqtt_client.on_disconnect = self.cb_disconnect
-            self.mqtt_client.on_msg = self.cb_msg
+            self.mqtt_client.on_message = self.cb_msg
+            self.mqtt_client.on_publish = self.cb_publish
             if self.config.username is not None and self.config.password is not None:
                 self.mqtt_client.username_pw_set(self.config.username, self.config.password)
             if self.config.tls:
@@ -89,34 +123,145 @@ class MqttEndpoint(CommandEndpoint):
     def cb_connect(self, client, userdata, flags, rc):
         self.connected = True
         self.log.info("MQTT connected")
-        client.subscribe(self.config.topic)
+        if self.config.response_topic is not None:
+            client.subscribe(self.config.response_topic)
+        self.loop.call_soon_threadsafe(self.flush)
 
     def cb_disconnect(self, client, userdata, rc):
         self.connected = False
         self.log.info("MQTT disconnected")
 
     def cb_msg(self, client, userdata, msg):
-        self.log.info(f"cb_msg: topic={msg.topic} payload={msg.payload}")
+        # runs in the paho network thread
+        self.log.debug(f"cb_msg: topic={msg.topic} payload={msg.payload}")
+        try:
+            payload = json.loads(msg.payload)
+            id = payload["correlation_id"]
+        except Exception as e:
+            self.log.warning(f"{self.name}: ignoring invalid response on {msg.topic}: {e}")
+            return
+
+        self.loop.call_soon_threadsafe(self.resolve, id, payload)
+
+    def cb_publish(self, client, userdata, mid):
+        # runs in the paho network thread
+        self.loop.call_soon_threadsafe(self.published_cb, mid, time.monotonic())
+
+    def published_cb(self, mid, ts):
+        queued_at = self.publishing.pop(mid, None)
+        if queued_at is not None:
+            self.published += 1
+            self.latencies.append(ts - queued_at)
+
+    def is_stale(self, queued_at, id, now):
+        # commands that went stale or whose sender stopped waiting for the response
+        return now - queued_at > MQTT_QUEUE_TTL or (id is not None and id not in self.pending)
+
+    def prune(self):
+        # flush only runs while connected, stale commands must not fill the queue meanwhile
+        now = time.monotonic()
+        queue = deque(entry for entry in self.queue if not self.is_stale(entry[0], entry[2], now))
+        self.expired += len(self.queue) - len(queue)
+        self.queue = queue
+
+    def flush(self):
+        now = time.monotonic()
+        while len(self.queue) > 0 and self.connected:
+            queued_at, payload, id = self.queue[0]
+            if self.is_stale(queued_at, id, now):
+                self.queue.popleft()
+                self.expired += 1
+                continue
+
+            info = self.mqtt_client.publish(self.config.topic, payload=payload, qos=self.config.qos)
+            # paho keeps QoS 1 and 2 messages it couldn't send yet, QoS 0 ones are lost
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and self.config.qos == 0:
+                break
+            self.queue.popleft()
+            self.publishing[info.mid] = queued_at
+
+        if len(self.queue) > 0:
+            self.log.debug(f"{self.name}: {len(self.queue)} messages queued")
+
+    def publish(self, payload, id=None):
+        self.prune()
+        if len(self.queue) >= MQTT_QUEUE_SIZE:
+            raise CommandEndpointUnavailableException(f"{self.name}: not connected and queue full")
+
+        self.queue.append((time.monotonic(), payload, id))
+        self.flush()
+
+    def resolve(self, id, payload):
+        future = self.pending.get(id)
+        if future is not None and not future.done():
+            future.set_result(payload)
+
+    def inflight(self):
+        self.prune()
+        return len(self.pending) + len(self.queue)
 
     def parse_response(self, response):
         res = CommandEndpointResult()
-        if response.ok:
-            res.ok = True
-            if len(res.speech) > 0:
-                res.speech = response.text
-            else:
-                res.speech = "Success!"
+        res.ok = bool(response.get("ok", True))
+        speech = response.get("speech")
+        if speech:
+            res.speech = speech
+        elif res.ok:
+            res.speech = "Success!"
 
         command_endpoint_response = CommandEndpointResponse(result=res)
         return command_endpoint_response.model_dump_json()
 
-    def send(self, data=None, jsondata=None, ws=None):
-        if not self.connected:
-            raise CommandEndpointRuntimeException(f"{self.name} not connected")
+    async def send(self, data=None, jsondata=None, ws=None):
+        # without a response topic commands are fire-and-forget
+        if self.config.response_topic is None or jsondata is None:
+            try:
+                if jsondata is not None:
+                    self.publish(json.dumps(jsondata))
+                else:
+                    self.publish(data)
+            except CommandEndpointRuntimeException:
+                raise
+            except Exception as e:
+                raise CommandEndpointRuntimeException(e)
+            return None
+
+        id = uuid4().hex
+        future = self.loop.create_future()
+        self.pending[id] = future
+        payload = {**jsondata, "correlation_id": id, "response_topic": self.config.response_topic}
+
         try:
-            if jsondata is not None:
-                self.mqtt_client.publish(self.config.topic, payload=json.dumps(jsondata))
-            else:
-                self.mqtt_client.publish(self.config.topic, payload=data)
+            self.publish(json.dumps(payload), id)
+            return await asyncio.wait_for(future, MQTT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise CommandEndpointTimeoutException(f"{self.name}: no response for request {id}")
+        except CommandEndpointRuntimeException:
+            raise
         except Exception as e:
             raise CommandEndpointRuntimeException(e)
+        finally:
+            self.pending.pop(id, None)
+
+    def status(self):
+        latencies = sorted(self.latencies)
+        return {
+            "name": self.name,
+            "connected": self.connected,
+            "queued": len(self.queue),
+            "inflight": len(self.pending),
+            "published": self.published,
+            "expired": self.expired,
+            "publish_latency_ms": {
+                "avg": sum(latencies) / len(latencies) * 1000 if latencies else None,
+                "p95": latencies[int(0.95 * (len(latencies) - 1))] * 1000 if latencies else None,
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+        }
+
+    async def stop(self):
+        self.log.info(f"stopping {self.name}")
+        if self.mqtt_client is not None:
+            self.mqtt_client.disconnect()
+            # loop_stop joins the network thread
+            await asyncio.to_thread(self.mqtt_client.loop_stop)
@@ -1,4 +1,4 @@
-import json
+import httpx
 import logging
 from . import (
     CommandEndpoint,
@@ -8,8 +8,11 @@ from . import (
     CommandEndpointRuntimeException
 )
 from enum import Enum
-from requests import request
-from requests.auth import HTTPBasicAuth
+
+
+# connect timeout is kept short so an unreachable endpoint fails fast
+REST_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=30)
+REST_TIMEOUT = httpx.Timeout(30, connect=1)
 
 
 class RestAuthType(Enum):
@@ -52,13 +55,16 @@ class RestConfig():
 class RestEndpoint(CommandEndpoint):
     name = "REST"
 
-    def __init__(self, url):
+    def __init__(self, url, limits=REST_LIMITS, timeout=REST_TIMEOUT):
         self.config = RestConfig()
         self.url = url
+        self.requests = 0
+        # one pooled client per endpoint so keep-alive connections are reused across commands
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout)
 
     def parse_response(self, response):
         res = CommandEndpointResult()
-        if response.ok:
+        if response.is_success:
             res.ok = True
             if len(res.speech) > 0:
                 res.speech = response.text
@@ -68,7 +74,11 @@ class RestEndpoint(CommandEndpoint):
         command_endpoint_response = CommandEndpointResponse(result=res)
         return command_endpoint_response.model_dump_json()
 
-    def send(self, data=None, jsondata=None, ws=None):
+    def inflight(self):
+        return self.requests
+
+    async def send(self, data=None, jsondata=None, ws=None):
+        self.requests += 1
         try:
             basic = None
             headers = {}
@@ -79,7 +89,7 @@ class RestEndpoint(CommandEndpoint):
                 headers['Content-Type'] = 'text/plain'
 
             if self.config.auth_type == RestAuthType.BASIC:
-                basic = HTTPBasicAuth(self.config.auth_user, self.config.auth_pass)
+                basic = httpx.BasicAuth(self.config.auth_user, self.config.auth_pass)
             elif self.config.auth_type == RestAuthType.HEADER:
                 headers['Authorization'] = self.config.auth_header
             elif self.config.auth_type == RestAuthType.NONE:
@@ -87,7 +97,13 @@ class RestEndpoint(CommandEndpoint):
             else:
                 raise CommandEndpointConfigException("invalid REST auth type")
 
-            return request("POST", self.url, auth=basic, data=data, headers=headers, json=jsondata, timeout=(1, 30))
+            return await self.client.post(self.url, auth=basic, content=data, headers=headers, json=jsondata)
 
         except Exception as e:
             raise CommandEndpointRuntimeException(e)
+        finally:
+            self.requests -= 1
+
+    async def stop(self):
+        self.log.info(f"stopping {self.name}")
+        await self.client.aclose()
@@ -0,0 +1,86 @@
+import copy
+import json
+import os
+import time
+
+from logging import getLogger
+
+
+log = getLogger("WAS")
+
+
+class ConfigEntry:
+    __slots__ = ("checked", "data", "frames", "stamp")
+
+    def __init__(self, data, stamp, checked):
+        self.checked = checked
+        self.data = data
+        self.frames = {}
+        self.stamp = stamp
+
+
+class ConfigStore:
+    """In-memory cache of the JSON documents in storage.
+
+    Documents are parsed once and kept with their pre-serialized WebSocket frames. Entries are
+    dropped on write through invalidate() and revalidated against the file mtime and size at most
+    once per check_interval, so files changed outside WAS are picked up as well.
+    """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self.entries = {}
+
+    def get(self, path, default=None):
+        entry = self._load(path)
+        if entry is None or entry.data is None:
+            return {} if default is None else copy.deepcopy(default)
+
+        # callers are free to modify what they get back
+        return copy.deepcopy(entry.data)
+
+    def get_msg(self, path, container):
+        entry = self._load(path)
+        if entry is None:
+            return json.dumps({container: {}}, sort_keys=True)
+
+        msg = entry.frames.get(container)
+        if msg is None:
+            msg = json.dumps({container: entry.data if entry.data is not None else {}}, sort_keys=True)
+            entry.frames[container] = msg
+
+        return msg
+
+    def invalidate(self, path):
+        self.entries.pop(path, None)
+
+    def _load(self, path):
+        now = time.monotonic()
+        entry = self.entries.get(path)
+        if entry is not None and now - entry.checked < self.check_interval:
+            return entry
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.entries.pop(path, None)
+            return None
+
+        stamp = (st.st_mtime_ns, st.st_size)
+        if entry is not None and entry.stamp == stamp:
+            entry.checked = now
+            return entry
+
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+        except Exception as e:
+            log.error(f"failed to load {path}: {e}")
+            data = None
+
+        entry = ConfigEntry(data, stamp, now)
+        self.entries[path] = entry
+        return entry
+
+
+config_store = ConfigStore()
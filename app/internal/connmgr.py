@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from fastapi import (
@@ -6,48 +7,95 @@ from fastapi import (
 )
 from typing import Dict
 
+from app.settings import get_settings
+
 from .client import Client
 
 
 log = logging.getLogger("WAS")
 
 
+class ClientWriter:
+    def __init__(self, connmgr, ws, queue_size, send_timeout):
+        self.connmgr = connmgr
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.send_timeout = send_timeout
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, msg):
+        try:
+            self.queue.put_nowait(msg)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def run(self):
+        while True:
+            msg = await self.queue.get()
+            try:
+                await asyncio.wait_for(self.ws.send_text(msg), self.send_timeout)
+            except Exception as e:
+                log.warning(f"failed to send message to client, disconnecting: {e}")
+                self.connmgr.close(self.ws)
+                return
+
+    def stop(self):
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
 class ConnMgr:
     def __init__(self):
+        settings = get_settings()
         self.connected_clients: Dict[WebSocket, Client] = {}
+        self.writers: Dict[WebSocket, ClientWriter] = {}
+        self.send_queue_size = settings.ws_send_queue_size
+        self.send_timeout = settings.ws_send_timeout
+        self.slow_client_policy = settings.ws_slow_client_policy
+        # secondary indexes, insertion ordered so the most recently registered connection wins
+        # when several connections share a hostname or MAC (e.g. a device reconnecting before
+        # its old connection timed out)
+        self.hostnames: Dict[str, Dict[WebSocket, None]] = {}
+        self.macs: Dict[str, Dict[WebSocket, None]] = {}
 
     async def accept(self, ws: WebSocket, client: Client):
         try:
             await ws.accept()
             self.connected_clients[ws] = client
+            self.writers[ws] = ClientWriter(self, ws, self.send_queue_size, self.send_timeout)
         except WebSocketException as e:
             log.error(f"Failed to accept websocket connection: {e}")
 
-    async def broadcast(self, msg: str):
-        for client in self.connected_clients:
-            try:
-                await client.send_text(msg)
-            except Exception as e:
-                log.error(f"Failed to broadcast message: {e}")
+    def broadcast(self, msg: str):
+        # only enqueues, every client has its own writer so a slow client can't delay the others
+        for ws in list(self.writers):
+            self.send(ws, msg)
+
+    def close(self, ws: WebSocket):
+        self.disconnect(ws)
+        asyncio.ensure_future(self._close(ws))
 
     def disconnect(self, ws: WebSocket):
         if ws in self.connected_clients:
-            self.connected_clients.pop(ws)
+            client = self.connected_clients.pop(ws)
+            self._unindex(self.hostnames, client.hostname, ws)
+            self._unindex(self.macs, client.mac_addr, ws)
+        if ws in self.writers:
+            self.writers.pop(ws).stop()
 
     def get_client_by_hostname(self, hostname):
-        for k, v in self.connected_clients.items():
-            if v.hostname == hostname:
-                return k
+        return self._lookup(self.hostnames, hostname)
 
     def get_client_by_ws(self, ws):
         return self.connected_clients[ws]
 
     def get_mac_by_hostname(self, hostname):
-        for k, v in self.connected_clients.items():
-            if v.hostname == hostname:
-                return v.mac_addr
+        ws = self._lookup(self.hostnames, hostname)
+        if ws is None:
+            return None
 
-        return None
+        return self.connected_clients[ws].mac_addr
 
     def get_client_hostname(self, ws):
         # Check if the client exists
@@ -56,27 +104,73 @@ class ConnMgr:
             return self.connected_clients[ws].hostname
         else:
             #client is not found
-            return None    
+            return None
 
     def get_ws_by_mac(self, mac):
-        for k, v in self.connected_clients.items():
-            # log.debug(f"get_ws_by_mac: {k} {v.mac_addr}")
-            if v.mac_addr == mac:
-                return k
+        ws = self._lookup(self.macs, mac)
+        if ws is None:
+            log.debug("get_ws_by_mac: returning None")
 
-        log.debug("get_ws_by_mac: returning None")
-        return None
+        return ws
 
     def is_notification_active(self, ws):
         return self.connected_clients[ws].is_notification_active()
 
+    def send(self, ws: WebSocket, msg: str):
+        writer = self.writers.get(ws)
+        if writer is None:
+            log.debug("send: client not connected")
+            return False
+
+        if writer.send(msg):
+            return True
+
+        if self.slow_client_policy == "disconnect":
+            log.warning(f"send queue full for {self.get_client_hostname(ws)}, disconnecting")
+            self.close(ws)
+        else:
+            log.warning(f"send queue full for {self.get_client_hostname(ws)}, dropping message")
+        return False
+
     def set_notification_active(self, ws, id):
         self.connected_clients[ws].set_notification_active(id)
 
     def update_client(self, ws, key, value):
+        client = self.connected_clients[ws]
         if key == "hostname":
-            self.connected_clients[ws].set_hostname(value)
+            self._unindex(self.hostnames, client.hostname, ws)
+            client.set_hostname(value)
+            self._index(self.hostnames, value, ws)
         elif key == "platform":
-            self.connected_clients[ws].set_platform(value)
+            client.set_platform(value)
         elif key == "mac_addr":
-            self.connected_clients[ws].set_mac_addr(value)
+            self._unindex(self.macs, client.mac_addr, ws)
+            client.set_mac_addr(value)
+            self._index(self.macs, value, ws)
+        elif key == "zone":
+            client.set_zone(value)
+
+    async def _close(self, ws):
+        try:
+            await asyncio.wait_for(ws.close(), self.send_timeout)
+        except Exception as e:
+            log.debug(f"failed to close websocket connection: {e}")
+
+    def _index(self, index, key, ws):
+        index.setdefault(key, {})[ws] = None
+
+    def _lookup(self, index, key):
+        entries = index.get(key)
+        if not entries:
+            return None
+
+        return next(reversed(entries))
+
+    def _unindex(self, index, key, ws):
+        entries = index.get(key)
+        if entries is None:
+            return
+
+        entries.pop(ws, None)
+        if not entries:
+            del index[key]
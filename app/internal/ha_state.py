@@ -0,0 +1,71 @@
+import time
+
+from logging import getLogger
+
+
+log = getLogger("WAS")
+
+
+class HomeAssistantStateCache:
+    """In-memory copy of the Home Assistant entity states.
+
+    Loaded from a get_states snapshot and kept up to date with state_changed events from the HA
+    WebSocket connection. The version is only bumped when entities are added, removed or renamed,
+    so consumers that only care about entity names can cheaply tell when to rebuild.
+    """
+
+    def __init__(self):
+        self.loaded_at = None
+        self.sorted_ids = None
+        self.states = {}
+        self.updates = 0
+        self.version = 0
+
+    def is_ready(self):
+        return self.loaded_at is not None
+
+    def invalidate(self):
+        # events are missed while disconnected, so the cache can't be trusted until reloaded
+        self.loaded_at = None
+
+    def load(self, states):
+        self.states = {state["entity_id"]: state for state in states}
+        self.loaded_at = time.time()
+        self.sorted_ids = None
+        self.version += 1
+        log.info(f"HA state cache: loaded {len(self.states)} entities")
+
+    def apply(self, data):
+        entity_id = data["entity_id"]
+        new_state = data.get("new_state")
+        old_state = self.states.get(entity_id)
+        self.updates += 1
+
+        if new_state is None:
+            if self.states.pop(entity_id, None) is not None:
+                self.sorted_ids = None
+                self.version += 1
+            return
+
+        self.states[entity_id] = new_state
+        if old_state is None:
+            self.sorted_ids = None
+            self.version += 1
+        elif old_state.get("attributes", {}).get("friendly_name") != new_state.get("attributes", {}).get("friendly_name"):
+            self.version += 1
+
+    def get(self, entity_id):
+        return self.states.get(entity_id)
+
+    def list(self):
+        if self.sorted_ids is None:
+            self.sorted_ids = sorted(self.states)
+        return [self.states[entity_id] for entity_id in self.sorted_ids]
+
+    def status(self):
+        return {
+            "entities": len(self.states),
+            "loaded_at": self.loaded_at,
+            "updates": self.updates,
+            "version": self.version,
+        }
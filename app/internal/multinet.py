@@ -0,0 +1,113 @@
+import re
+
+from functools import lru_cache
+from logging import getLogger
+
+from num2words import num2words
+
+
+log = getLogger("WAS")
+
+# ESP_MN_MAX_PHRASE_LEN
+MULTINET_MAX_PHRASE_LEN = 63
+# Multinet supports at most this many commands on the device
+MULTINET_MAX_PHRASES = 400
+MULTINET_DOMAINS = ["fan", "input_boolean", "light", "switch"]
+
+RE_INVALID = re.compile(r'[^A-Za-z- ]')
+RE_NUMBER = re.compile(r'\d+')
+
+
+@lru_cache(maxsize=1024)
+def number_to_words(number):
+    return f" {num2words(int(number))} "
+
+
+def normalize_phrase(phrase):
+    phrase = RE_NUMBER.sub(lambda m: number_to_words(m.group()), phrase)
+    phrase = phrase.replace('_', ' ')
+    phrase = RE_INVALID.sub('', phrase)
+    return " ".join(phrase.split()).upper()
+
+
+def get_commands_for_name(name, max_phrase_len=MULTINET_MAX_PHRASE_LEN):
+    name = normalize_phrase(name)
+    if not name:
+        return []
+
+    on = f'TURN ON {name}'
+    off = f'TURN OFF {name}'
+
+    if len(off) < max_phrase_len:
+        return [on, off]
+
+    return []
+
+
+def get_entity_names(states, domains=MULTINET_DOMAINS):
+    names = {}
+    for state in states:
+        domain, _, object_id = state["entity_id"].partition(".")
+        if domain not in domains:
+            continue
+        names[state["entity_id"]] = state.get("attributes", {}).get("friendly_name") or object_id
+
+    return names
+
+
+class MultinetGenerator:
+    """Generates multinet commands for HA entities, incrementally.
+
+    Only entities that were added, removed or renamed since the previous update are processed,
+    the commands for the others are reused. The result is limited to the number of phrases
+    multinet supports on the device.
+    """
+
+    def __init__(self, max_phrases=MULTINET_MAX_PHRASES, max_phrase_len=MULTINET_MAX_PHRASE_LEN):
+        self.entities = {}
+        self.max_phrase_len = max_phrase_len
+        self.max_phrases = max_phrases
+        self.sorted_ids = []
+        self.truncated = 0
+
+    def update(self, names):
+        """Update the commands for a mapping of entity ID to name, returns change counts"""
+        added = renamed = 0
+        removed = len(self.entities.keys() - names.keys())
+        entities = {}
+
+        for entity_id, name in names.items():
+            current = self.entities.get(entity_id)
+            if current is not None and current[0] == name:
+                entities[entity_id] = current
+                continue
+
+            if current is None:
+                added += 1
+            else:
+                renamed += 1
+            entities[entity_id] = (name, get_commands_for_name(name, self.max_phrase_len))
+
+        if added or removed:
+            self.sorted_ids = sorted(entities)
+        self.entities = entities
+
+        return {"added": added, "removed": removed, "renamed": renamed}
+
+    def commands(self):
+        commands = []
+        seen = set()
+        for entity_id in self.sorted_ids:
+            for command in self.entities[entity_id][1]:
+                if command not in seen:
+                    seen.add(command)
+                    commands.append(command)
+
+        self.truncated = max(0, len(commands) - self.max_phrases)
+        if self.truncated > 0:
+            log.warning(f"multinet: dropping {self.truncated} commands over the {self.max_phrases} phrase limit")
+
+        return commands[:self.max_phrases]
+
+
+multinet_generator = MultinetGenerator()
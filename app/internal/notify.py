@@ -1,16 +1,23 @@
 import asyncio
-import json
+import heapq
+import itertools
 import time
 
+from collections import deque
 from logging import getLogger
-from pydantic import BaseModel, ConfigDict, Field
-from typing import Annotated, Dict, List, Optional
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, TypeAdapter
+from typing import Annotated, Deque, Dict, List, Optional, Set
 
 from .connmgr import ConnMgr
+from .notify_journal import NotifyJournal
 
 
 log = getLogger("WAS")
 
+# TODO should we make this configurable ?
+# or at least reject notifications with old ID in the API
+NOTIFY_EXPIRE_MS = 3600 * 1000
+
 
 class NotifyData(BaseModel):
     model_config = ConfigDict(extra="forbid")
@@ -22,7 +29,16 @@ class NotifyData(BaseModel):
     repeat: int = 1
     strobe_period_ms: Optional[int] = 0
     text: Optional[str] = None
-    volume: Optional[int] = Optional[Annotated[int, Field(ge=0, le=100)]]
+    volume: Optional[Annotated[int, Field(ge=0, le=100)]] = None
+
+    _frame: Optional[str] = PrivateAttr(default=None)
+
+    def frame(self):
+        # serialized once and shared by every device the notification is queued for
+        if self._frame is None:
+            msg = NotifyMsg(data=self)
+            self._frame = msg.model_dump_json(exclude={'hostname'}, exclude_none=True)
+        return self._frame
 
 
 class NotifyMsg(BaseModel):
@@ -33,89 +49,185 @@ class NotifyMsg(BaseModel):
     hostname: Optional[str] = None
 
 
+NotifyMsgList = TypeAdapter(List[NotifyMsg])
+
+
 class NotifyQueue(BaseModel):
+    """Per-device notification queues driven by a time ordered heap.
+
+    The scheduler sleeps until the next notification is due, or until it is woken up by add, done
+    or a device connecting, and only looks at the devices that may have something to send.
+    """
+
     model_config = ConfigDict(arbitrary_types_allowed=True, extra="forbid")
 
     connmgr: ConnMgr = None
+    journal: NotifyJournal = None
     notifications: Dict[str, List[NotifyData]] = {}
     task: asyncio.Task = None
 
+    _dirty: Set[str] = PrivateAttr(default_factory=set)
+    _heap: List = PrivateAttr(default_factory=list)
+    _last_id: int = PrivateAttr(default=0)
+    _ready: Dict[str, Deque[NotifyData]] = PrivateAttr(default_factory=dict)
+    _seq: itertools.count = PrivateAttr(default_factory=itertools.count)
+    _wakeup: asyncio.Event = PrivateAttr(default_factory=asyncio.Event)
+
+    def restore(self, pending):
+        restored = 0
+        for mac_addr, notifications in pending.items():
+            for data in notifications:
+                self.schedule(mac_addr, NotifyData.model_validate(data), journal=False)
+                restored += 1
+        log.info(f"restored {restored} pending notifications")
+
+    def snapshot(self):
+        return [(mac_addr, n) for mac_addr, notifications in self.notifications.items() for n in notifications]
+
     def start(self):
         loop = asyncio.get_event_loop()
         self.task = loop.create_task(self.dequeue())
+        if self.journal is not None:
+            self.journal.start(self.snapshot)
+
+    async def stop(self):
+        self.task.cancel()
+        if self.journal is not None:
+            await self.journal.stop()
+
+    @staticmethod
+    def validate(msgs):
+        return NotifyMsgList.validate_python(msgs)
 
     def add(self, msg):
-        msg = NotifyMsg.model_validate_json(json.dumps(msg))
-        if not hasattr(msg.data, "id") or msg.data.id < 0:
-            msg.data.id = int(time.time() * 1000)
-
-        log.debug(msg)
-
-        if msg.hostname is not None:
-            mac_addr = self.connmgr.get_mac_by_hostname(msg.hostname)
-            if mac_addr == "unknown":
-                log.warn(f"no MAC address found for {msg.hostname}, skipping notification")
-                return
-            if mac_addr in self.notifications:
-                self.notifications[mac_addr].append(msg.data)
-            else:
-                self.notifications.update({mac_addr: [msg.data]})
-
-        else:
-            for _, client in self.connmgr.connected_clients.items():
-                if client.mac_addr == "unknown":
-                    log.warn(f"no MAC address found for {client.hostname}, skipping")
-                    continue
-                if client.mac_addr in self.notifications:
-                    self.notifications[client.mac_addr].append(msg.data)
+        return self.add_batch(self.validate([msg]))[0]
+
+    def add_batch(self, msgs):
+        results = []
+        for msg in msgs:
+            if msg.data.id < 0:
+                # IDs double as due time, keep generated ones unique within a batch
+                msg.data.id = max(int(time.time() * 1000), self._last_id + 1)
+                self._last_id = msg.data.id
+
+            log.debug(msg)
+            msg.data.frame()
+            queued = 0
+
+            if msg.hostname is not None:
+                mac_addr = self.connmgr.get_mac_by_hostname(msg.hostname)
+                if mac_addr is None or mac_addr == "unknown":
+                    log.warn(f"no MAC address found for {msg.hostname}, skipping notification")
                 else:
-                    self.notifications.update({client.mac_addr: [msg.data]})
+                    self.schedule(mac_addr, msg.data)
+                    queued += 1
+
+            else:
+                for _, client in self.connmgr.connected_clients.items():
+                    if client.mac_addr == "unknown":
+                        log.warn(f"no MAC address found for {client.hostname}, skipping")
+                        continue
+                    self.schedule(client.mac_addr, msg.data)
+                    queued += 1
+
+            results.append({"id": msg.data.id, "hostname": msg.hostname, "queued": queued})
+
+        return results
 
     def done(self, ws, id):
         client = self.connmgr.get_client_by_ws(ws)
-        for i, notification in enumerate(self.notifications[client.mac_addr]):
+        for i, notification in enumerate(self.notifications.get(client.mac_addr, [])):
             if notification.id == id:
                 self.connmgr.set_notification_active(ws, 0)
                 self.notifications[client.mac_addr].pop(i)
+                if self.journal is not None:
+                    self.journal.done(client.mac_addr, id)
                 break
 
         data = NotifyData(id=id, cancel=True)
         # explicitly set cmd so we can use exclude_unset
         msg_cancel = NotifyMsg(cmd="notify", data=data)
         log.info(msg_cancel)
-        asyncio.ensure_future(self.connmgr.broadcast(msg_cancel.model_dump_json(exclude_unset=True)))
+        self.connmgr.broadcast(msg_cancel.model_dump_json(exclude_unset=True))
+        self.wakeup(client.mac_addr)
+
+    def schedule(self, mac_addr, notification, journal=True):
+        self.notifications.setdefault(mac_addr, []).append(notification)
+        if journal and self.journal is not None:
+            self.journal.add(mac_addr, notification)
+        heapq.heappush(self._heap, (notification.id, next(self._seq), mac_addr, notification))
+        self._wakeup.set()
+
+    def wakeup(self, mac_addr=None):
+        if mac_addr is not None:
+            self._dirty.add(mac_addr)
+        self._wakeup.set()
+
+    def is_pending(self, mac_addr, notification):
+        return any(n is notification for n in self.notifications.get(mac_addr, []))
+
+    def send_next(self, mac_addr, now):
+        ready = self._ready.get(mac_addr)
+        if not ready:
+            return
+
+        ws = self.connmgr.get_ws_by_mac(mac_addr)
+        if ws is None:
+            return
+        if self.connmgr.is_notification_active(ws):
+            log.debug(f"{mac_addr} has active notification")
+            return
+
+        while ready:
+            notification = ready[0]
+            if not self.is_pending(mac_addr, notification):
+                ready.popleft()
+                continue
+
+            if notification.id < now - NOTIFY_EXPIRE_MS:
+                log.warning("expiring notification older than 1h")
+                ready.popleft()
+                self.notifications[mac_addr].remove(notification)
+                if self.journal is not None:
+                    self.journal.expire(mac_addr, notification.id)
+                continue
+
+            self.connmgr.set_notification_active(ws, notification.id)
+            log.debug(f"dequeueing notification for {mac_addr}: {notification}")
+            self.connmgr.send(ws, notification.frame())
+            if self.journal is not None:
+                self.journal.deliver(mac_addr, notification.id)
+            # don't send more than one notification at once
+            break
+
+        if not ready:
+            del self._ready[mac_addr]
 
     async def dequeue(self):
         while True:
+            timeout = None
             try:
-                for mac_addr, notifications in self.notifications.items():
-                    # log.debug(f"dequeueing notifications for {mac_addr}: {notifications} (len={len(notifications)})")
-                    if len(notifications) > 0:
-                        ws = self.connmgr.get_ws_by_mac(mac_addr)
-                        if ws is None:
-                            continue
-                        if self.connmgr.is_notification_active(ws):
-                            log.debug(f"{mac_addr} has active notification")
-                            continue
-
-                        for i, notification in enumerate(notifications):
-                            if notification.id > int(time.time() * 1000):
-                                continue
-                            elif notification.id < int((time.time() - 3600) * 1000):
-                                # TODO should we make this configurable ?
-                                # or at least use a constant and reject notifications with old ID in the API
-                                log.warning("expiring notification older than 1h")
-                                notifications.pop(i)
-
-                            self.connmgr.set_notification_active(ws, notification.id)
-                            log.debug(f"dequeueing notification for {mac_addr}: {notification}")
-                            msg = NotifyMsg(data=notification)
-                            asyncio.ensure_future(ws.send_text(
-                                msg.model_dump_json(exclude={'hostname'}, exclude_none=True))
-                            )
-                            # don't send more than one notification at once
-                            break
+                now = int(time.time() * 1000)
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, mac_addr, notification = heapq.heappop(self._heap)
+                    if not self.is_pending(mac_addr, notification):
+                        continue
+                    self._ready.setdefault(mac_addr, deque()).append(notification)
+                    self._dirty.add(mac_addr)
+
+                for mac_addr in self._dirty:
+                    self.send_next(mac_addr, now)
+                self._dirty.clear()
+
+                if self._heap:
+                    timeout = max(self._heap[0][0] - now, 0) / 1000
             except Exception as e:
                 log.debug(f"exception during dequeue: {e}")
+                self._dirty.clear()
+                timeout = 1
 
-            await asyncio.sleep(1)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
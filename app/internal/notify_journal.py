@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+
+from logging import getLogger
+
+from .persist import write_file_atomic
+
+
+log = getLogger("WAS")
+
+
+class NotifyJournal:
+    """Append-only on-disk journal of notification state transitions.
+
+    Records are buffered in memory and appended with a single fsync every flush_interval seconds,
+    so adding a notification never waits for the disk. Once the journal holds a lot more records
+    than there are pending notifications it is compacted to one add record per pending
+    notification.
+    """
+
+    def __init__(self, path, flush_interval=1.0, compact_min=1000, compact_ratio=4):
+        self.buffer = []
+        self.compact_min = compact_min
+        self.compact_ratio = compact_ratio
+        self.flush_interval = flush_interval
+        self.path = path
+        self.records = 0
+        self.snapshot = None
+        self.stopping = asyncio.Event()
+        self.task = None
+
+    def add(self, mac_addr, data):
+        self.append({"op": "add", "mac_addr": mac_addr, "data": data.model_dump()})
+
+    def deliver(self, mac_addr, id):
+        self.append({"op": "deliver", "mac_addr": mac_addr, "id": id})
+
+    def done(self, mac_addr, id):
+        self.append({"op": "done", "mac_addr": mac_addr, "id": id})
+
+    def expire(self, mac_addr, id):
+        self.append({"op": "expire", "mac_addr": mac_addr, "id": id})
+
+    def append(self, record):
+        self.buffer.append(json.dumps(record, separators=(',', ':')))
+
+    def replay(self):
+        notifications = {}
+        if not os.path.isfile(self.path):
+            return notifications
+
+        records = 0
+        with open(self.path, "r") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn write at the end of the journal
+                    log.warning(f"skipping invalid record in {self.path}")
+                    continue
+                records += 1
+
+                pending = notifications.setdefault(record["mac_addr"], [])
+                if record["op"] == "add":
+                    pending.append(record["data"])
+                elif record["op"] in ("done", "expire"):
+                    for i, data in enumerate(pending):
+                        if data["id"] == record["id"]:
+                            pending.pop(i)
+                            break
+
+        self.records = records
+        return {k: v for k, v in notifications.items() if len(v) > 0}
+
+    def start(self, snapshot):
+        self.snapshot = snapshot
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # let a flush or compaction in progress finish, cancelling it could lose the records it took
+        self.stopping.set()
+        if self.task is not None:
+            await self.task
+        await self.flush()
+
+    async def run(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                await self.compact()
+            except Exception as e:
+                log.error(f"failed to write notification journal: {e}")
+
+    async def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        lines, self.buffer = self.buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except Exception:
+            self.buffer = lines + self.buffer
+            raise
+        self.records += len(lines)
+
+    async def compact(self):
+        if self.snapshot is None:
+            return
+
+        # the snapshot already contains everything that is still buffered
+        live = self.snapshot()
+        if self.records < self.compact_min or self.records < self.compact_ratio * len(live):
+            return
+
+        buffered, self.buffer = self.buffer, []
+        lines = [json.dumps({"op": "add", "mac_addr": mac_addr, "data": data.model_dump()}, separators=(',', ':'))
+                 for mac_addr, data in live]
+        content = "".join(f"{line}\n" for line in lines)
+        try:
+            await asyncio.to_thread(write_file_atomic, self.path, content)
+        except Exception:
+            self.buffer = buffered + self.buffer
+            raise
+        log.debug(f"compacted notification journal from {self.records} to {len(lines)} records")
+        self.records = len(lines)
+
+    def _write(self, lines):
+        with open(self.path, "a") as journal:
+            journal.write("".join(f"{line}\n" for line in lines))
+            journal.flush()
+            os.fsync(journal.fileno())
@@ -0,0 +1,116 @@
+import asyncio
+import httpx
+import os
+import tempfile
+
+from hashlib import sha256
+from logging import getLogger
+
+from ..const import DIR_OTA
+from .ota_index import ota_index
+from .persist import fsync_dir, write_file_atomic
+
+
+log = getLogger("WAS")
+
+OTA_CHUNK_SIZE = 64 * 1024
+
+
+class OtaChecksumException(Exception):
+    pass
+
+
+def get_ota_checksum(path):
+    # written next to every image downloaded by the OtaDownloader
+    try:
+        with open(f"{path}.sha256", "r") as file:
+            return file.read().strip()
+    except OSError:
+        pass
+
+    # local images are hashed by the OTA index instead
+    dir, name = os.path.split(path)
+    if os.path.abspath(dir) == os.path.abspath(f"{DIR_OTA}/local"):
+        return ota_index.update(dir).get(name, {}).get("sha256")
+
+    return None
+
+
+class OtaDownloader:
+    """Streams OTA images into the OTA cache directory.
+
+    Images are written to a temporary file in chunks while their sha256 is computed, and only
+    renamed into place once complete and verified. Concurrent requests for the same version and
+    platform share one download.
+    """
+
+    def __init__(self, dir):
+        self.client = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(60, connect=5))
+        self.dir = dir
+        self.inflight = {}
+
+    async def close(self):
+        await self.client.aclose()
+
+    def get_path(self, version, platform):
+        return os.path.join(self.dir, version, f"{platform}.bin")
+
+    async def fetch(self, version, platform, url, checksum=None, size=None):
+        key = (version, platform)
+        task = self.inflight.get(key)
+        if task is None:
+            path = self.get_path(version, platform)
+            task = asyncio.create_task(self._download(url, path, checksum, size))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            log.debug(f"OTA: attaching to download of {version}/{platform} in progress")
+
+        # a device giving up must not cancel the download for the others
+        return await asyncio.shield(task)
+
+    async def _download(self, url, path, checksum, size):
+        dir = os.path.dirname(path)
+        await asyncio.to_thread(os.makedirs, dir, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=dir, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        file = os.fdopen(fd, "wb")
+        hash = sha256()
+        length = 0
+        log.info(f"OTA: downloading {url}")
+        try:
+            async with self.client.stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(OTA_CHUNK_SIZE):
+                    hash.update(chunk)
+                    length += len(chunk)
+                    await asyncio.to_thread(file.write, chunk)
+
+            await asyncio.to_thread(self._finish, file)
+
+            digest = hash.hexdigest()
+            if checksum is not None and digest != checksum.lower():
+                raise OtaChecksumException(f"sha256 mismatch for {url}: expected {checksum}, got {digest}")
+            if size is not None and length != size:
+                raise OtaChecksumException(f"size mismatch for {url}: expected {size}, got {length}")
+
+            await asyncio.to_thread(self._commit, tmp, path, digest)
+        except BaseException:
+            file.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        log.info(f"OTA: cached {path} ({length} bytes, sha256 {digest})")
+        return path
+
+    def _commit(self, tmp, path, digest):
+        os.chmod(tmp, 0o644)
+        write_file_atomic(f"{path}.sha256", digest)
+        os.replace(tmp, path)
+        fsync_dir(os.path.dirname(path))
+
+    def _finish(self, file):
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
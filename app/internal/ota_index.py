@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+
+from hashlib import sha256
+from logging import getLogger
+
+from ..const import STORAGE_OTA_INDEX
+from .persist import write_file_atomic
+
+
+log = getLogger("WAS")
+
+OTA_INDEX_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    hash = sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(OTA_INDEX_CHUNK_SIZE):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+class OtaIndex:
+    """Persistent metadata index of the OTA images in a directory.
+
+    Entries are keyed by file name and only rehashed when the size or mtime of the file changes.
+    Every image keeps the ID it was first indexed with. update() does blocking I/O, call it from a
+    worker thread.
+    """
+
+    def __init__(self, path=STORAGE_OTA_INDEX):
+        self.entries = None
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                index = json.load(file)
+            self.entries = index["entries"]
+            self.next_id = index["next_id"]
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            log.warning(f"OTA index: failed to load {self.path}, rebuilding: {e}")
+            self.entries = {}
+
+    def save(self):
+        index = {"entries": self.entries, "next_id": self.next_id}
+        write_file_atomic(self.path, json.dumps(index, sort_keys=True))
+
+    def update(self, dir):
+        """Sync the index with the .bin files in dir, returns a copy of the entries by file name"""
+        with self.lock:
+            if self.entries is None:
+                self.load()
+
+            changed = False
+            seen = set()
+            try:
+                files = [f for f in os.scandir(dir) if f.name.endswith(".bin") and f.is_file()]
+            except FileNotFoundError:
+                files = []
+
+            for file in files:
+                seen.add(file.name)
+                st = file.stat()
+                entry = self.entries.get(file.name)
+                if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                    continue
+
+                start = time.monotonic()
+                checksum = hash_file(file.path)
+                log.info(f"OTA index: hashed {file.name} in {time.monotonic() - start:.2f}s")
+
+                if entry is None:
+                    entry = {"id": self.next_id}
+                    self.next_id += 1
+                entry.update({
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.localtime(st.st_ctime)),
+                    "mtime_ns": st.st_mtime_ns,
+                    "sha256": checksum,
+                    "size": st.st_size,
+                })
+                self.entries[file.name] = entry
+                changed = True
+
+            for name in list(self.entries):
+                if name not in seen:
+                    del self.entries[name]
+                    changed = True
+
+            if changed:
+                try:
+                    self.save()
+                except Exception as e:
+                    log.error(f"OTA index: failed to save {self.path}: {e}")
+
+            return {name: dict(entry) for name, entry in self.entries.items()}
+
+
+ota_index = OtaIndex()
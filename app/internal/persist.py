@@ -0,0 +1,65 @@
+import asyncio
+import os
+import tempfile
+
+from logging import getLogger
+
+
+log = getLogger("WAS")
+
+
+def write_file_atomic(path, content):
+    dir = os.path.dirname(path) or "."
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+
+    fd, tmp = tempfile.mkstemp(dir=dir, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    fsync_dir(dir)
+
+
+def fsync_dir(dir):
+    # make renames in the directory durable
+    dir_fd = os.open(dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class FileWriter:
+    """Write files atomically in a worker thread.
+
+    Writes to the same path are serialized. Saves that arrive while a write is in progress are
+    coalesced so only the latest content is written, and every caller returns once content at
+    least as new as its own is on disk.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.pending = {}
+
+    async def write(self, path, content):
+        self.pending[path] = content
+        lock = self.locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            if path not in self.pending:
+                log.debug(f"save of {path} coalesced with a previous write")
+                return
+            content = self.pending.pop(path)
+            await asyncio.to_thread(write_file_atomic, path, content)
+
+
+file_writer = FileWriter()
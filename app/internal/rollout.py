@@ -0,0 +1,275 @@
+import asyncio
+import json
+import time
+
+from logging import getLogger
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Literal, Optional
+
+from .was import get_devices, get_release_url, get_was_url
+
+
+log = getLogger("WAS")
+
+# how often the rollout checks for devices that timed out
+ROLLOUT_TICK = 1.0
+
+
+class RolloutException(Exception):
+    pass
+
+
+class RolloutSelector(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    type: Literal["all", "label", "platform"] = "all"
+    value: Optional[str] = None
+
+
+class RolloutParams(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    version: str
+    selector: RolloutSelector = RolloutSelector()
+    # devices per wave, the next wave only starts once every device in the current one finished
+    wave_size: int = Field(10, ge=1)
+    # devices updating at the same time within a wave
+    concurrency: int = Field(5, ge=1)
+    # pause the rollout once this many devices failed
+    max_failures: int = Field(3, ge=1)
+    # seconds a device gets to come back with the new version
+    timeout: int = Field(600, ge=30)
+
+
+def get_client_version(client):
+    if client.ua is None:
+        return None
+    return client.ua.replace("Willow/", "")
+
+
+class RolloutDevice:
+    __slots__ = ("error", "finished_at", "hostname", "mac_addr", "platform", "started_at", "state")
+
+    def __init__(self, mac_addr, hostname, platform):
+        self.error = None
+        self.finished_at = None
+        self.hostname = hostname
+        self.mac_addr = mac_addr
+        self.platform = platform
+        self.started_at = None
+        # pending -> updating -> done | failed, devices already on the version are skipped and
+        # devices not done when the rollout is cancelled are cancelled
+        self.state = "pending"
+
+    def finish(self, state, error=None):
+        self.error = error
+        self.finished_at = time.time()
+        self.state = state
+
+    def status(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class Rollout:
+    """Updates a set of devices to a version in waves.
+
+    A device counts as updated when it reconnects and its user agent reports the target version.
+    A device that reconnects with another version, can't be reached or doesn't come back in time
+    has failed, and the rollout pauses once max_failures devices failed.
+    """
+
+    def __init__(self, connmgr, params, devices, was_url):
+        self.connmgr = connmgr
+        self.devices = {device.mac_addr: device for device in devices}
+        self.params = params
+        self.was_url = was_url
+
+        self.changed = asyncio.Event()
+        self.created_at = time.time()
+        # failures from before the last resume don't count towards max_failures again
+        self.failures_resumed = 0
+        self.finished_at = None
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.state = "running"
+        self.task = None
+        self.wave = 0
+
+        order = list(self.devices.values())
+        self.waves = [order[i:i + params.wave_size] for i in range(0, len(order), params.wave_size)]
+
+    def count(self, state):
+        return sum(1 for device in self.devices.values() if device.state == state)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def pause(self):
+        if self.state == "running":
+            self.state = "paused"
+            self.resumed.clear()
+
+    def resume(self):
+        if self.state == "paused":
+            self.failures_resumed = self.count("failed")
+            self.state = "running"
+            self.resumed.set()
+
+    def cancel(self):
+        if self.state not in ["running", "paused"]:
+            return
+        if self.task is not None:
+            self.task.cancel()
+        self.finish("cancelled")
+
+    def finish(self, state):
+        self.finished_at = time.time()
+        self.state = state
+        for device in self.devices.values():
+            if device.state == "pending":
+                device.finish("cancelled")
+            elif device.state == "updating":
+                # nobody watches for it coming back anymore, it may or may not apply the update
+                device.finish("cancelled", "cancelled while updating")
+
+    def on_hello(self, mac_addr, version):
+        device = self.devices.get(mac_addr)
+        if device is None or device.state != "updating":
+            return
+
+        # a device reconnecting quickly with the old version didn't apply the update
+        if version == self.params.version:
+            device.finish("done")
+            log.info(f"rollout: {device.hostname} updated to {version}")
+        else:
+            device.finish("failed", f"reconnected with version {version}")
+            log.warning(f"rollout: {device.hostname} reconnected with version {version}")
+        self.changed.set()
+
+    def start_device(self, device):
+        device.started_at = time.time()
+        device.state = "updating"
+
+        ws = self.connmgr.get_ws_by_mac(device.mac_addr)
+        url = get_release_url(self.was_url, self.params.version, device.platform)
+        msg = json.dumps({'cmd': 'ota_start', 'ota_url': url})
+        if ws is None or not self.connmgr.send(ws, msg):
+            device.finish("failed", "not connected")
+            log.warning(f"rollout: {device.hostname} not connected")
+            return
+
+        log.info(f"rollout: updating {device.hostname} to {self.params.version}")
+
+    def check_timeouts(self, now):
+        for device in self.devices.values():
+            if device.state == "updating" and now - device.started_at > self.params.timeout:
+                device.finish("failed", "timed out")
+                log.warning(f"rollout: {device.hostname} timed out")
+
+    async def run(self):
+        for i, wave in enumerate(self.waves):
+            self.wave = i + 1
+            while True:
+                await self.resumed.wait()
+                self.check_timeouts(time.time())
+
+                if self.count("failed") - self.failures_resumed >= self.params.max_failures:
+                    log.warning(f"rollout: pausing after {self.count('failed')} failed devices")
+                    self.pause()
+                    continue
+
+                updating = sum(1 for device in wave if device.state == "updating")
+                for device in wave:
+                    if updating >= self.params.concurrency:
+                        break
+                    if device.state == "pending":
+                        self.start_device(device)
+                        if device.state == "updating":
+                            updating += 1
+
+                if all(device.state not in ["pending", "updating"] for device in wave):
+                    break
+
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), ROLLOUT_TICK)
+                except asyncio.TimeoutError:
+                    pass
+
+        self.finish("finished")
+        log.info(f"rollout to {self.params.version} finished: {self.count('done')} updated, "
+                 f"{self.count('failed')} failed, {self.count('skipped')} skipped")
+
+    def status(self):
+        done = self.count("done")
+        end = self.finished_at or time.time()
+        elapsed = end - self.created_at
+        return {
+            "params": self.params.model_dump(),
+            "state": self.state,
+            "wave": self.wave,
+            "waves": len(self.waves),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "counts": {state: self.count(state) for state in
+                       ["pending", "updating", "done", "failed", "skipped", "cancelled"]},
+            "devices_per_minute": done / elapsed * 60 if elapsed > 0 else 0,
+            "devices": [device.status() for device in self.devices.values()],
+        }
+
+
+class RolloutManager:
+    """Runs at most one rollout at a time and feeds it the devices reconnecting."""
+
+    def __init__(self, connmgr):
+        self.connmgr = connmgr
+        self.rollout = None
+
+    def select(self, selector):
+        labels = {device.get("mac_addr"): device.get("label") for device in get_devices()}
+        selected = {}
+        for client in self.connmgr.connected_clients.values():
+            if client.mac_addr == "unknown" or client.mac_addr in selected:
+                continue
+            if selector.type == "platform" and client.platform != selector.value:
+                continue
+            if selector.type == "label" and labels.get(client.mac_addr) != selector.value:
+                continue
+            selected[client.mac_addr] = client
+
+        return selected.values()
+
+    def start(self, params):
+        if self.rollout is not None and self.rollout.state in ["running", "paused"]:
+            raise RolloutException("a rollout is already in progress")
+
+        was_url = get_was_url()
+        if not was_url:
+            raise RolloutException("WAS URL not set")
+        # devices would fail to download the image one by one otherwise
+        if get_release_url(was_url, params.version, "") is None:
+            raise RolloutException(f"invalid WAS URL {was_url}")
+
+        devices = []
+        for client in sorted(self.select(params.selector), key=lambda c: c.hostname or ""):
+            device = RolloutDevice(client.mac_addr, client.hostname, client.platform)
+            if get_client_version(client) == params.version:
+                device.finish("skipped")
+            devices.append(device)
+
+        if len(devices) == 0:
+            raise RolloutException("no connected devices match the selector")
+
+        self.rollout = Rollout(self.connmgr, params, devices, was_url)
+        self.rollout.start()
+        log.info(f"rollout to {params.version} started for {len(devices)} devices")
+        return self.rollout
+
+    def on_hello(self, mac_addr, client):
+        if self.rollout is not None and self.rollout.state in ["running", "paused"]:
+            self.rollout.on_hello(mac_addr, get_client_version(client))
+
+    def status(self):
+        if self.rollout is None:
+            return None
+        return self.rollout.status()
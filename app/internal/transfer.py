@@ -0,0 +1,269 @@
+import asyncio
+import os
+import time
+
+from email.utils import formatdate
+from logging import getLogger
+
+from fastapi.responses import Response, StreamingResponse
+
+
+log = getLogger("WAS")
+
+TRANSFER_CHUNK_SIZE = 64 * 1024
+# how often a transfer waiting for a slot checks whether the client is still there
+TRANSFER_POLL_INTERVAL = 1.0
+TRANSFER_RETRY_AFTER = 30
+# 0 waits for a slot for as long as the client stays connected
+TRANSFER_WAIT_TIMEOUT = 0
+
+
+class TokenBucket:
+    """Limits throughput to rate bytes per second, 0 disables the limit.
+
+    Consumers may overdraw the bucket, they then sleep until the debt is paid back. This keeps
+    concurrent consumers of the same bucket fair without needing a queue.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.ts = time.monotonic()
+
+    async def consume(self, n):
+        if self.rate <= 0:
+            return
+
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class TransferClient:
+    __slots__ = ("bucket", "slots", "users")
+
+    def __init__(self, concurrency, rate):
+        self.bucket = TokenBucket(rate)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.users = 0
+
+
+class TransferLimiter:
+    """Bounds the number and bandwidth of file transfers, globally and per client.
+
+    Transfers over the limits wait for a slot in FIFO order, so a fleet-wide update proceeds in
+    batches instead of every device competing for the uplink at once. Transfers wait for as long
+    as their client stays connected, unless a timeout is set. Transfers that don't get a slot
+    within the timeout are turned away, and the client is told to retry later.
+    """
+
+    def __init__(self, concurrency, client_concurrency, rate=0, client_rate=0, timeout=TRANSFER_WAIT_TIMEOUT):
+        self.bucket = TokenBucket(rate)
+        self.client_concurrency = client_concurrency
+        self.client_rate = client_rate
+        self.clients = {}
+        self.slots = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+
+        self.active = 0
+        self.sent = 0
+        self.waiting = 0
+
+    async def acquire(self, host, disconnected=None):
+        """Wait for a global and a client slot
+
+        Returns None when the client went away, as told by the disconnected coroutine function,
+        or no slot freed up within the timeout.
+        """
+        client = self.clients.get(host)
+        if client is None:
+            client = TransferClient(self.client_concurrency, self.client_rate)
+            self.clients[host] = client
+        client.users += 1
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout if self.timeout > 0 else None
+        task = asyncio.create_task(self._acquire(client))
+
+        self.waiting += 1
+        try:
+            while not task.done():
+                wait = TRANSFER_POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - loop.time())
+                if wait > 0:
+                    await asyncio.wait([task], timeout=wait)
+                if task.done():
+                    break
+                if (deadline is not None and loop.time() >= deadline) or \
+                        (disconnected is not None and await disconnected()):
+                    await self._cancel(task, client)
+                    self._release_client(host, client)
+                    return None
+        except BaseException:
+            await asyncio.shield(self._cancel(task, client))
+            self._release_client(host, client)
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        return client
+
+    async def _cancel(self, task, client):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        else:
+            # the slots were acquired just before the cancellation
+            self.slots.release()
+            client.slots.release()
+
+    async def _acquire(self, client):
+        # wait for a slot of the client first, so it doesn't hold a global slot meanwhile
+        await client.slots.acquire()
+        try:
+            await self.slots.acquire()
+        except BaseException:
+            client.slots.release()
+            raise
+
+    def release(self, host, client):
+        self.active -= 1
+        self.slots.release()
+        client.slots.release()
+        self._release_client(host, client)
+
+    def _release_client(self, host, client):
+        client.users -= 1
+        if client.users == 0:
+            self.clients.pop(host, None)
+
+    async def throttle(self, client, n):
+        await client.bucket.consume(n)
+        await self.bucket.consume(n)
+        self.sent += n
+
+    def status(self):
+        return {
+            "active": self.active,
+            "clients": len(self.clients),
+            "sent": self.sent,
+            "waiting": self.waiting,
+        }
+
+
+class TransferResponse(StreamingResponse):
+    """Streams a file and gives back the transfer slots once the response is done"""
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+def parse_range(header, size):
+    """Parse a single byte range, returns None for ranges we serve in full
+
+    Raises ValueError when the range can't be satisfied.
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first == "":
+            # suffix range: the last n bytes
+            start = max(0, size - int(last))
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        raise ValueError(f"range {header} not satisfiable for size {size}")
+
+    return start, end
+
+
+def etag_matches(header, etag):
+    # If-None-Match uses weak comparison
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+async def send_file(request, limiter, path, media_type=None, etag=None):
+    """Serve a file with ETag and Range support, throttled by the transfer limiter"""
+    st = await asyncio.to_thread(os.stat, path)
+    size = st.st_size
+    if etag is None:
+        etag = f'W/"{size:x}-{st.st_mtime_ns:x}"'
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    start = 0
+    end = size - 1
+    status_code = 200
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # resume only if the file is still the one the client started downloading
+    if range_header is not None and (if_range is None or (if_range == etag and not etag.startswith("W/"))):
+        try:
+            parsed = parse_range(range_header, size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+        if parsed is not None:
+            start, end = parsed
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    # the slots are taken before the response starts, so a busy server can still say so
+    host = request.client.host if request.client is not None else None
+    client = await limiter.acquire(host, request.is_disconnected)
+    if client is None:
+        log.info(f"transfer of {os.path.basename(path)} to {host} gave up waiting for a slot")
+        return Response(status_code=503, headers={"Retry-After": str(TRANSFER_RETRY_AFTER)})
+
+    headers["Content-Length"] = str(end - start + 1)
+
+    async def stream():
+        file = await asyncio.to_thread(open, path, "rb")
+        try:
+            await asyncio.to_thread(file.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(file.read, min(TRANSFER_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                await limiter.throttle(client, len(chunk))
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            file.close()
+
+    return TransferResponse(stream(), lambda: limiter.release(host, client), status_code=status_code,
+                            media_type=media_type, headers=headers)
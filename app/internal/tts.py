@@ -0,0 +1,160 @@
+import asyncio
+import httpx
+import os
+
+from collections import OrderedDict
+from hashlib import sha256
+from logging import getLogger
+from urllib.parse import parse_qs, urlparse
+
+from .persist import write_file_atomic
+from .was import get_tts_url, get_was_url
+
+
+log = getLogger("WAS")
+
+TTS_EXTENSIONS = {
+    "audio/flac": ".flac",
+    "audio/x-flac": ".flac",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/mpeg": ".mp3",
+}
+TTS_MEDIA_TYPES = {
+    ".flac": "audio/flac",
+    ".wav": "audio/x-wav",
+    ".mp3": "audio/mpeg",
+}
+
+
+class TtsCache:
+    """Content addressed on-disk cache of TTS audio.
+
+    Audio is keyed by the sha256 of the TTS URL, which includes the text, voice and WIS instance.
+    Concurrent requests for the same URL share one download and the least recently used entries
+    are evicted once the cache grows past max_size bytes, except for the audio of notifications
+    that are still pending.
+    """
+
+    def __init__(self, dir, max_size, in_use=None):
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(60, connect=1), verify=False)
+        self.dir = dir
+        self.entries = OrderedDict()
+        self.in_use = in_use
+        self.inflight = {}
+        self.max_size = max_size
+        self.size = 0
+
+    def load(self):
+        os.makedirs(self.dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.dir):
+            key, ext = os.path.splitext(name)
+            if ext not in TTS_MEDIA_TYPES:
+                continue
+            st = os.stat(os.path.join(self.dir, name))
+            files.append((st.st_mtime, key, name, st.st_size))
+
+        for _, key, name, size in sorted(files):
+            self.entries[key] = (name, size)
+            self.size += size
+        log.info(f"TTS cache: loaded {len(self.entries)} entries ({self.size} bytes)")
+
+    async def close(self):
+        await self.client.aclose()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, None
+
+        self.entries.move_to_end(key)
+        name, _ = entry
+        return os.path.join(self.dir, name), TTS_MEDIA_TYPES[os.path.splitext(name)[1]]
+
+    async def fetch(self, url):
+        key = sha256(url.encode()).hexdigest()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return key
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._download(url, key))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+        try:
+            await asyncio.shield(task)
+        except Exception as e:
+            log.warning(f"TTS cache: failed to fetch {url}: {e}")
+            return None
+
+        return key
+
+    async def prepare(self, msgs):
+        # without a URL devices can reach WAS on, they keep fetching the audio themselves
+        was_url = get_was_url()
+        own_url = get_tts_url(was_url, "")
+        if own_url is None:
+            log.warning("TTS cache: WAS URL not set or invalid, not caching notification audio")
+            return
+
+        # don't cache our own URLs when a cached notification is submitted again
+        urls = set()
+        for msg in msgs:
+            url = msg.data.audio_url
+            if url is not None and "/api/tts" in url and not url.startswith(own_url):
+                urls.add(url)
+
+        if len(urls) == 0:
+            return
+
+        keys = await asyncio.gather(*[self.fetch(url) for url in urls])
+        keys = dict(zip(urls, keys))
+        for msg in msgs:
+            key = keys.get(msg.data.audio_url)
+            if key is not None:
+                msg.data.audio_url = get_tts_url(was_url, key)
+        log.debug("TTS ready - passing to clients")
+
+    async def _download(self, url, key):
+        response = await self.client.get(url)
+        response.raise_for_status()
+
+        content_type = response.headers.get("content-type", "").split(";")[0].strip()
+        name = f"{key}{TTS_EXTENSIONS.get(content_type, '.wav')}"
+        await asyncio.to_thread(write_file_atomic, os.path.join(self.dir, name), response.content)
+
+        self.entries[key] = (name, len(response.content))
+        self.size += len(response.content)
+        self.evict()
+
+    def get_pinned(self):
+        # keys of the audio that pending notifications point devices to
+        pinned = set()
+        if self.in_use is None:
+            return pinned
+
+        for url in self.in_use():
+            if url is not None and "/api/tts" in url:
+                pinned.update(parse_qs(urlparse(url).query).get("id", []))
+        return pinned
+
+    def evict(self):
+        if self.size <= self.max_size:
+            return
+
+        pinned = self.get_pinned()
+        # the newest entry is never evicted, it was just fetched for a notification
+        for key in list(self.entries)[:-1]:
+            if self.size <= self.max_size:
+                break
+            if key in pinned:
+                continue
+            name, size = self.entries.pop(key)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.dir, name))
+            except OSError as e:
+                log.warning(f"TTS cache: failed to remove {name}: {e}")
@@ -0,0 +1,98 @@
+import asyncio
+import copy
+import httpx
+import json
+import os
+import time
+
+from hashlib import sha256
+from logging import getLogger
+
+from ..const import STORAGE_UPSTREAM_CACHE
+from .persist import file_writer
+
+
+log = getLogger("WAS")
+
+UPSTREAM_TIMEOUT = httpx.Timeout(10, connect=3)
+UPSTREAM_TTL = 3600
+
+
+class UpstreamCache:
+    """Cache for JSON fetched from upstream (heywillow.io).
+
+    Fresh entries are served from memory. Stale entries are served as well while they are
+    refreshed in the background, so only the very first fetch of a URL waits for upstream.
+    Concurrent fetches of the same URL are coalesced, and the last good response of every URL is
+    persisted so WAS keeps working without internet access, even across restarts.
+    """
+
+    def __init__(self, dir=STORAGE_UPSTREAM_CACHE):
+        self.client = httpx.AsyncClient(follow_redirects=True, timeout=UPSTREAM_TIMEOUT)
+        self.dir = dir
+        self.entries = {}
+        self.inflight = {}
+
+    async def close(self):
+        await self.client.aclose()
+
+    def get_path(self, url):
+        return os.path.join(self.dir, f"{sha256(url.encode()).hexdigest()}.json")
+
+    def load(self, url):
+        try:
+            with open(self.get_path(url), "r") as file:
+                entry = json.load(file)
+            return entry["fetched_at"], entry["data"]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"upstream cache: failed to load last good copy of {url}: {e}")
+            return None
+
+    async def get(self, url, ttl=UPSTREAM_TTL):
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = await asyncio.to_thread(self.load, url)
+            if entry is not None:
+                self.entries.setdefault(url, entry)
+
+        if entry is None:
+            # nothing to serve yet, so this one has to wait for upstream
+            await asyncio.shield(self.refresh(url))
+            entry = self.entries[url]
+        elif time.time() - entry[0] > ttl:
+            self.refresh(url)
+
+        # callers are free to modify what they get
+        return copy.deepcopy(entry[1])
+
+    def refresh(self, url):
+        task = self.inflight.get(url)
+        if task is None:
+            task = asyncio.create_task(self._fetch(url))
+            self.inflight[url] = task
+            task.add_done_callback(lambda t: self._done(url, t))
+        return task
+
+    def _done(self, url, task):
+        self.inflight.pop(url, None)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning(f"upstream cache: failed to fetch {url}: {task.exception()}")
+
+    async def _fetch(self, url):
+        response = await self.client.get(url)
+        response.raise_for_status()
+        data = response.json()
+        fetched_at = time.time()
+        self.entries[url] = (fetched_at, data)
+
+        try:
+            await asyncio.to_thread(os.makedirs, self.dir, exist_ok=True)
+            content = json.dumps({"data": data, "fetched_at": fetched_at, "url": url})
+            await file_writer.write(self.get_path(url), content)
+        except Exception as e:
+            log.error(f"upstream cache: failed to save last good copy of {url}: {e}")
+
+
+upstream_cache = UpstreamCache()
@@ -2,6 +2,7 @@ import asyncio
 import json
 import time
 
+from collections import deque
 from logging import getLogger
 from uuid import uuid4
 
@@ -13,22 +14,123 @@ class WakeEvent:
     def __init__(self, client, volume):
         self.client = client
         self.volume = volume
+        self.ts = time.monotonic()
+
+
+class WakeStats:
+    """Statistics learned from past wake sessions.
+
+    Counts which devices report together so a session can be decided as soon as every device that
+    usually hears the first one has reported, and keeps recent report arrival offsets to adapt the
+    arbitration deadline.
+    """
+
+    def __init__(self, min_sessions=5, threshold=0.5, max_sessions=100, samples=200, min_samples=20):
+        self.arrivals = deque(maxlen=samples)
+        self.max_sessions = max_sessions
+        self.min_samples = min_samples
+        self.min_sessions = min_sessions
+        self.pairs = {}
+        self.sessions = {}
+        self.threshold = threshold
+
+    def deadline(self, default, minimum, maximum):
+        if len(self.arrivals) < self.min_samples:
+            return default
+
+        arrivals = sorted(self.arrivals)
+        p95 = arrivals[int(0.95 * (len(arrivals) - 1))]
+        return min(max(p95 * 1.5, minimum), maximum)
+
+    def expected(self, first, connected):
+        count = self.sessions.get(first, 0)
+        if count < self.min_sessions:
+            return None
+
+        expected = {first}
+        for other, n in self.pairs.get(first, {}).items():
+            if other in connected and n / count >= self.threshold:
+                expected.add(other)
+
+        return expected
+
+    def record(self, keys, arrivals):
+        self.arrivals.extend(arrivals)
+        for key in keys:
+            count = self.sessions.get(key, 0) + 1
+            pairs = self.pairs.setdefault(key, {})
+            for other in keys:
+                if other != key:
+                    pairs[other] = pairs.get(other, 0) + 1
+
+            # age out old history so devices that were moved are forgotten
+            if count > self.max_sessions:
+                count //= 2
+                for other in list(pairs):
+                    pairs[other] //= 2
+                    if pairs[other] == 0:
+                        del pairs[other]
+            self.sessions[key] = count
 
 
 class WakeSession:
-    def __init__(self):
+    def __init__(self, connmgr, stats=None, timeout=400, min_timeout=100):
+        self.complete = asyncio.Event()
+        self.connmgr = connmgr
         self.done = False
         self.events = []
+        self.expected = None
         self.id = uuid4()
-        self.ts = time.time()
+        self.keys = {}
+        self.stats = stats
+        self.ts = time.monotonic()
+        self.window = timeout / 1000
+        if stats is not None:
+            self.timeout = stats.deadline(self.window, min_timeout / 1000, self.window)
+        else:
+            self.timeout = self.window
         log.debug(f"WakeSession with ID {self.id} created")
 
     def add_event(self, event):
         log.debug(f"WakeSession {self.id} adding event {event}")
+        key = self.get_key(event.client)
+        if key in self.keys:
+            return
+
+        self.keys[key] = event.ts
+
+        if self.done:
+            # reported after the session was decided, it can only lose
+            log.debug(f"WakeSession {self.id} late event from {key}")
+            self.connmgr.send(event.client, json.dumps({'wake_result': {'won': False}}))
+            return
+
         self.events.append(event)
 
-    async def cleanup(self, timeout=400):
-        await asyncio.sleep(timeout / 1000)
+        if self.stats is not None:
+            if self.expected is None and len(self.events) == 1:
+                self.expected = self.stats.expected(key, self.connmgr.macs)
+            if self.expected is not None and self.expected.issubset(self.keys):
+                self.complete.set()
+
+    def get_key(self, ws):
+        try:
+            mac_addr = self.connmgr.get_client_by_ws(ws).mac_addr
+        except KeyError:
+            mac_addr = "unknown"
+
+        # without a MAC address we can't learn anything about the device
+        return mac_addr if mac_addr != "unknown" else ws
+
+    def is_open(self):
+        return time.monotonic() - self.ts < self.window
+
+    async def cleanup(self):
+        try:
+            await asyncio.wait_for(self.complete.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+
         max_volume = -1000.0
         winner = None
         for event in self.events:
@@ -37,11 +139,47 @@ class WakeSession:
                 winner = event.client
 
         # notify winner first
-        await winner.send_text(json.dumps({'wake_result': {'won': True}}))
+        self.connmgr.send(winner, json.dumps({'wake_result': {'won': True}}))
 
         for event in self.events:
             if event.client != winner:
-                await event.client.send_text(json.dumps({'wake_result': {'won': False}}))
+                self.connmgr.send(event.client, json.dumps({'wake_result': {'won': False}}))
 
-        log.debug(f"Marking WakeSession with ID {self.id} done. Winner: {winner}")
+        log.debug(f"Marking WakeSession with ID {self.id} done after {(time.monotonic() - self.ts) * 1000:.0f} ms. "
+                  f"Winner: {winner}")
         self.done = True
+
+        if self.stats is not None:
+            # keep collecting late reports until the window closes so they're learned as well
+            await asyncio.sleep(max(self.window - (time.monotonic() - self.ts), 0))
+            keys = [key for key in self.keys if isinstance(key, str)]
+            first = min(self.keys.values())
+            self.stats.record(keys, [ts - first for ts in self.keys.values() if ts != first])
+
+
+class WakeArbiter:
+    """Run wake arbitration independently per zone.
+
+    Devices are assigned to a zone through the device configuration, devices without a zone are
+    arbitrated together in the default zone.
+    """
+
+    def __init__(self, connmgr):
+        self.connmgr = connmgr
+        self.sessions = {}
+        self.stats = WakeStats()
+        self.tasks = {}
+
+    def add_event(self, event):
+        try:
+            zone = self.connmgr.get_client_by_ws(event.client).zone
+        except KeyError:
+            zone = None
+
+        session = self.sessions.get(zone)
+        if session is None or not session.is_open():
+            session = WakeSession(self.connmgr, self.stats)
+            self.sessions[zone] = session
+            self.tasks[zone] = asyncio.create_task(session.cleanup())
+
+        session.add_event(event)
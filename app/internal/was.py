@@ -1,18 +1,14 @@
+import asyncio
 import json
 import magic
 import os
-import random
-import re
 import requests
 import socket
-import time
 import urllib
 import urllib3
 
-from hashlib import sha256
 from logging import getLogger
 
-from num2words import num2words
 from websockets.sync.client import connect
 
 from ..const import (
@@ -26,11 +22,18 @@ from ..const import (
     URL_WILLOW_RELEASES,
     URL_WILLOW_TZ,
 )
+from .config_store import config_store
+from .ota_index import ota_index
+from .persist import file_writer
+from .upstream import upstream_cache
 
 
 log = getLogger("WAS")
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+OTA_LOCAL_RELEASE_ID = 1
+UPSTREAM_RELEASES_TTL = 600
+
 
 def build_msg(config, container):
     try:
@@ -72,81 +75,43 @@ def construct_wis_tts_url(url):
 
 
 async def device_command(connmgr, data, command):
-    if 'hostname' in data:
-        hostname = data["hostname"]
+    hostname = data.get("hostname")
 
     msg = json.dumps({'cmd': command})
-    try:
-        ws = connmgr.get_client_by_hostname(hostname)
-        await ws.send_text(msg)
+    ws = connmgr.get_client_by_hostname(hostname)
+    if connmgr.send(ws, msg):
         return "Success"
-    except Exception as e:
-        log.error(f"Failed to send restart command to {data['hostname']} ({e})")
-        return "Error"
-
-
-def do_get_request(url, verify=False, timeout=(1, 60)):
-    try:
-        parsed_url = urllib.parse.urlparse(url)
-
-        if parsed_url.username and parsed_url.password:
-            # Request with auth
-            basic_auth = requests.auth.HTTPBasicAuth(parsed_url.username, parsed_url.password)
-            response = requests.get(url, verify=verify, timeout=timeout, auth=basic_auth)
-        else:
-            # Request without auth
-            response = requests.get(url, verify=verify, timeout=timeout)
-        return response
 
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        return None
+    log.error(f"Failed to send {command} command to {hostname} (not connected)")
+    return "Error"
 
 
 def get_config():
-    return get_json_from_file(STORAGE_USER_CONFIG)
-
+    return config_store.get(STORAGE_USER_CONFIG)
 
-def get_devices():
-    devices = []
 
-    if os.path.isfile(STORAGE_USER_CLIENT_CONFIG):
-        with open(STORAGE_USER_CLIENT_CONFIG, "r") as devices_file:
-            devices = json.load(devices_file)
-        devices_file.close()
-    else:
-        with open(STORAGE_USER_CLIENT_CONFIG, "x") as devices_file:
-            json.dump(devices, devices_file)
-        devices_file.close()
+def get_config_msg():
+    return config_store.get_msg(STORAGE_USER_CONFIG, "config")
 
-    return devices
 
+def get_devices():
+    return config_store.get(STORAGE_USER_CLIENT_CONFIG, [])
 
-def get_ha_commands_for_entity(entity):
-    commands = []
-    pattern = r'[^A-Za-z- ]'
-
-    numbers = re.search(r'(\d{1,})', entity)
-    if numbers:
-        for number in numbers.groups():
-            entity = entity.replace(number, f" {num2words(int(number))} ")
-
-    entity = entity.replace('_', ' ')
-    entity = re.sub(pattern, '', entity)
-    entity = " ".join(entity.split())
-    entity = entity.upper()
 
-    on = f'TURN ON {entity}'
-    off = f'TURN OFF {entity}'
+def get_device_zone(mac_addr):
+    for device in get_devices():
+        if device.get("mac_addr") == mac_addr:
+            # devices without a zone share the default zone
+            return device.get("zone") or None
 
-    # ESP_MN_MAX_PHRASE_LEN=63
-    if len(off) < 63:
-        commands.extend([on, off])
+    return None
 
-    return commands
 
+def get_ha_entities(url, token, state_cache=None):
+    # the state cache is kept up to date by the HA WebSocket endpoint
+    if state_cache is not None and state_cache.is_ready():
+        return state_cache.list()
 
-def get_ha_entities(url, token):
     if token is None:
         return json.dumps({'error': 'HA token not set'})
 
@@ -169,90 +134,71 @@ def get_ip():
     return ip
 
 
-def get_json_from_file(path):
-    try:
-        with open(path, "r") as file:
-            data = json.load(file)
-        file.close()
-    except Exception:
-        data = {}
-
-    return data
-
-
 def get_mime_type(filename):
     mime_type = magic.Magic(mime=True).from_file(filename)
     return mime_type
 
 
 def get_multinet():
-    return get_json_from_file(STORAGE_USER_MULTINET)
+    return config_store.get(STORAGE_USER_MULTINET)
 
 
 def get_nvs():
-    return get_json_from_file(STORAGE_USER_NVS)
+    return config_store.get(STORAGE_USER_NVS)
+
+
+def get_nvs_msg():
+    return config_store.get_msg(STORAGE_USER_NVS, "nvs")
 
 
-# TODO: Support HTTPs
 def get_release_url(was_url, version, platform):
-    url_parts = re.match(r"^(?:\w+:\/\/)?([^\/:]+)(?::(\d+))?", was_url)
-    host = url_parts.group(1)
-    port = url_parts.group(2)
-    url = f"http://{host}:{port}/api/ota?version={version}&platform={platform}"
-    return url
+    return get_was_http_url(was_url, "/api/ota", {"version": version, "platform": platform})
 
 
-# TODO: Find a better way but we need to handle every error possible
 def get_releases_local():
     local_dir = f"{DIR_OTA}/local"
-    assets = []
-    if not os.path.exists(local_dir):
-        return assets
-
-    url = "https://heywillow.io"
-
-    for asset_name in os.listdir(local_dir):
-        if '.bin' in asset_name:
-            file = f"{DIR_OTA}/local/{asset_name}"
-            created_at = os.path.getctime(file)
-            created_at = time.ctime(created_at)
-            created_at = time.strptime(created_at)
-            created_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", created_at)
-            with open(file, "rb") as f:
-                bytes = f.read()
-                checksum = sha256(bytes).hexdigest()
-            asset = {}
-            asset["name"] = f"willow-ota-{asset_name}"
-            asset["tag_name"] = f"willow-ota-{asset_name}"
-            asset["platform"] = asset_name.replace('.bin', '')
-            asset["platform_name"] = asset["platform"]
-            asset["platform_image"] = "https://heywillow.io/images/esp32_s3_box.png"
-            asset["build_type"] = "ota"
-            asset["url"] = url
-            asset["id"] = random.randint(10, 99)
-            asset["content_type"] = "raw"
-            asset["size"] = os.path.getsize(file)
-            asset["created_at"] = created_at
-            asset["browser_download_url"] = url
-            asset["sha256"] = checksum
-            assets.append(asset)
-
-    if assets == []:
+    entries = ota_index.update(local_dir)
+    if len(entries) == 0:
         return []
-    else:
-        return [{"name": "local",
-                 "tag_name": "local",
-                 "id": random.randint(10, 99),
-                 "url": url,
-                 "html_url": url,
-                 "assets": assets}]
 
+    url = "https://heywillow.io"
+    assets = []
 
-def get_releases_willow():
-    releases = requests.get(URL_WILLOW_RELEASES)
-    releases = releases.json()
+    for asset_name, entry in sorted(entries.items()):
+        asset = {}
+        asset["name"] = f"willow-ota-{asset_name}"
+        asset["tag_name"] = f"willow-ota-{asset_name}"
+        asset["platform"] = asset_name.replace('.bin', '')
+        asset["platform_name"] = asset["platform"]
+        asset["platform_image"] = "https://heywillow.io/images/esp32_s3_box.png"
+        asset["build_type"] = "ota"
+        asset["url"] = url
+        asset["id"] = entry["id"]
+        asset["content_type"] = "raw"
+        asset["size"] = entry["size"]
+        asset["created_at"] = entry["created_at"]
+        asset["browser_download_url"] = url
+        asset["sha256"] = entry["sha256"]
+        assets.append(asset)
+
+    return [{"name": "local",
+             "tag_name": "local",
+             "id": OTA_LOCAL_RELEASE_ID,
+             "url": url,
+             "html_url": url,
+             "assets": assets}]
+
+
+async def get_releases_willow():
+    try:
+        releases = await upstream_cache.get(URL_WILLOW_RELEASES, ttl=UPSTREAM_RELEASES_TTL)
+    except Exception as e:
+        # offline without a last good copy, local images can still be used
+        log.error(f"failed to fetch Willow releases: {e}")
+        releases = []
     try:
-        releases_local = get_releases_local()
+        # hashing new local images is blocking
+        releases_local = await asyncio.to_thread(get_releases_local)
     except Exception:
         pass
     else:
@@ -260,6 +206,10 @@ def get_releases_willow():
     return releases
 
 
+def get_tts_url(was_url, id):
+    return get_was_http_url(was_url, "/api/tts", {"id": id})
+
+
 def get_tz():
     try:
         with open("tz.json", "r") as config_file:
@@ -271,18 +221,44 @@ def get_tz():
     return tz
 
 
-def get_tz_config(refresh=False):
+async def get_tz_config(refresh=False):
     if refresh:
-        tz = requests.get(URL_WILLOW_TZ).json()
-        with open(STORAGE_TZ, "w") as tz_file:
-            json.dump(tz, tz_file)
-        tz_file.close()
+        try:
+            tz = await upstream_cache.get(URL_WILLOW_TZ)
+        except Exception as e:
+            log.error(f"failed to fetch TZ config, keeping the current one: {e}")
+        else:
+            if tz != config_store.get(STORAGE_TZ):
+                await save_json_to_file(STORAGE_TZ, json.dumps(tz))
 
-    return get_json_from_file(STORAGE_TZ)
+    return config_store.get(STORAGE_TZ)
 
 
 def get_was_config():
-    return get_json_from_file(STORAGE_USER_WAS)
+    return config_store.get(STORAGE_USER_WAS)
+
+
+def get_was_http_url(was_url, path, query=None):
+    """Build the HTTP URL devices reach WAS on from the WAS URL in NVS, returns None if that is invalid"""
+    if not was_url:
+        return None
+    if "://" not in was_url:
+        was_url = f"ws://{was_url}"
+
+    try:
+        parsed = urllib.parse.urlsplit(was_url)
+        host = parsed.hostname
+        port = parsed.port
+    except ValueError:
+        return None
+    if not host:
+        return None
+
+    scheme = "https" if parsed.scheme in ["https", "wss"] else "http"
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host if port is None else f"{host}:{port}"
+    return urllib.parse.urlunsplit((scheme, netloc, path, urllib.parse.urlencode(query or {}), ""))
 
 
 def get_was_url():
@@ -311,15 +287,13 @@ async def post_config(request, apply=False):
     data = await request.json()
     if 'hostname' in data:
         hostname = data["hostname"]
-        data = get_config()
-        msg = build_msg(json.dumps(data), "config")
-        try:
-            ws = request.app.connmgr.get_client_by_hostname(hostname)
-            await ws.send_text(msg)
+        msg = get_config_msg()
+        ws = request.app.connmgr.get_client_by_hostname(hostname)
+        if request.app.connmgr.send(ws, msg):
             return "Success"
-        except Exception as e:
-            log.error(f"Failed to apply config to {hostname} ({e})")
-            return "Error"
+
+        log.error(f"Failed to apply config to {hostname} (not connected)")
+        return "Error"
     else:
         if "wis_tts_url" in data:
             data["wis_tts_url_v2"] = construct_wis_tts_url(data["wis_tts_url"])
@@ -327,11 +301,11 @@ async def post_config(request, apply=False):
             log.debug(f"wis_tts_url_v2: {data['wis_tts_url_v2']}")
 
         data = json.dumps(data)
-        save_json_to_file(STORAGE_USER_CONFIG, data)
+        await save_json_to_file(STORAGE_USER_CONFIG, data)
         msg = build_msg(data, "config")
         log.debug(str(msg))
         if apply:
-            await request.app.connmgr.broadcast(msg)
+            request.app.connmgr.broadcast(msg)
         return "Success"
 
 
@@ -339,42 +313,31 @@ async def post_nvs(request, apply=False):
     data = await request.json()
     if 'hostname' in data:
         hostname = data["hostname"]
-        data = get_nvs()
-        msg = build_msg(json.dumps(data), "nvs")
-        try:
-            ws = request.app.connmgr.get_client_by_hostname(hostname)
-            await ws.send_text(msg)
+        msg = get_nvs_msg()
+        ws = request.app.connmgr.get_client_by_hostname(hostname)
+        if request.app.connmgr.send(ws, msg):
             return "Success"
-        except Exception as e:
-            log.error(f"Failed to apply config to {hostname} ({e})")
-            return "Error"
+
+        log.error(f"Failed to apply config to {hostname} (not connected)")
+        return "Error"
     else:
         data = json.dumps(data)
-        save_json_to_file(STORAGE_USER_NVS, data)
+        await save_json_to_file(STORAGE_USER_NVS, data)
         msg = build_msg(data, "nvs")
         log.debug(str(msg))
         if apply:
-            await request.app.connmgr.broadcast(msg)
+            request.app.connmgr.broadcast(msg)
         return "Success"
 
 
 async def post_was(request, apply=False):
     data = await request.json()
     data = json.dumps(data)
-    save_json_to_file(STORAGE_USER_WAS, data)
+    await save_json_to_file(STORAGE_USER_WAS, data)
     return "Success"
 
 
-def save_json_to_file(path, content):
-    with open(path, "w") as config_file:
-        config_file.write(content)
-    config_file.close()
-
+async def save_json_to_file(path, content):
+    await file_writer.write(path, content)
+    config_store.invalidate(path)
 
-def warm_tts(data):
-    try:
-        if "/api/tts" in data["audio_url"]:
-            do_get_request(data["audio_url"])
-            log.debug("TTS ready - passing to clients")
-    except Exception:
-        pass
@@ -19,17 +19,20 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from app.const import (
     DIR_OTA,
-    STORAGE_USER_CONFIG,
+    DIR_TTS_CACHE,
+    STORAGE_NOTIFY_JOURNAL,
 )
 
 from app.internal.command_endpoints import (
     CommandEndpointResponse,
     CommandEndpointResult,
-    CommandEndpointRuntimeException
+    CommandEndpointRuntimeException,
+    CommandEndpointTimeoutException,
 )
-from app.internal.command_endpoints.main import init_command_endpoint
+from app.internal.command_endpoints.main import init_command_endpoint, retry_command_endpoint
 from app.internal.was import (
-    build_msg,
+    get_config_msg,
+    get_device_zone,
     get_tz_config,
 )
 from app.settings import get_settings
@@ -37,14 +40,22 @@ from app.settings import get_settings
 from .internal.client import Client
 from .internal.connmgr import ConnMgr
 from .internal.notify import NotifyQueue
-from .internal.wake import WakeEvent, WakeSession
+from .internal.notify_journal import NotifyJournal
+from .internal.ota import OtaDownloader
+from .internal.rollout import RolloutManager
+from .internal.transfer import TransferLimiter
+from .internal.upstream import upstream_cache
+from .internal.tts import TtsCache
+from .internal.wake import WakeArbiter, WakeEvent
 from .routers import asset
 from .routers import client
 from .routers import config
 from .routers import info
 from .routers import ota
 from .routers import release
+from .routers import rollout
 from .routers import status
+from .routers import tts
 
 
 logging.basicConfig(
@@ -63,21 +74,47 @@ settings = get_settings()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     migrate_user_files()
-    get_tz_config(refresh=True)
+    await get_tz_config(refresh=True)
 
     app.connmgr = ConnMgr()
+    app.wake_arbiter = WakeArbiter(app.connmgr)
+    app.rollout_manager = RolloutManager(app.connmgr)
 
+    app.command_endpoint_retry = None
     try:
-        init_command_endpoint(app)
+        await init_command_endpoint(app)
     except Exception as e:
         app.command_endpoint = None
-        log.error(f"failed to initialize command endpoint ({e})")
+        app.ha_state_cache = None
+        log.error(f"failed to initialize command endpoint, retrying in the background ({e})")
+        app.command_endpoint_retry = asyncio.create_task(retry_command_endpoint(app))
 
-    app.notify_queue = NotifyQueue(connmgr=app.connmgr)
+    app.notify_queue = NotifyQueue(connmgr=app.connmgr, journal=NotifyJournal(STORAGE_NOTIFY_JOURNAL))
+    app.notify_queue.restore(await asyncio.to_thread(app.notify_queue.journal.replay))
     app.notify_queue.start()
 
+    # audio of pending notifications, restored ones included, is kept until they are done
+    app.tts_cache = TtsCache(DIR_TTS_CACHE, settings.tts_cache_size_mb * 1024 * 1024,
+                             in_use=lambda: [n.audio_url for _, n in app.notify_queue.snapshot()])
+    await asyncio.to_thread(app.tts_cache.load)
+
+    app.ota_downloader = OtaDownloader(DIR_OTA)
+    app.transfer_limiter = TransferLimiter(
+        settings.transfer_concurrency,
+        settings.transfer_client_concurrency,
+        rate=settings.transfer_rate_limit,
+        client_rate=settings.transfer_client_rate_limit,
+        timeout=settings.transfer_wait_timeout,
+    )
+
     yield
     log.info("shutting down")
+    if app.command_endpoint_retry is not None:
+        app.command_endpoint_retry.cancel()
+    await app.notify_queue.stop()
+    await app.tts_cache.close()
+    await app.ota_downloader.close()
+    await upstream_cache.close()
 
 app = FastAPI(title="Willow Application Server",
               description="Willow Management API",
@@ -87,7 +124,7 @@ app = FastAPI(title="Willow Application Server",
               redoc_url="/redoc",
               version=settings.was_version)
 
-wake_session = None
+command_tasks = set()
 
 app.add_middleware(
     CORSMiddleware,
@@ -119,16 +156,38 @@ Path(DIR_OTA).mkdir(parents=True, exist_ok=True)
 app.mount("/admin", StaticFiles(directory="static/admin", html=True), name="admin")
 
 
-def get_config_ws():
-    config = None
+async def send_command_endpoint(websocket, data):
+    if app.command_endpoint is None:
+        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint not active")
+        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
+        app.connmgr.send(websocket, command_endpoint_response.model_dump_json())
+        log.error("WAS Command Endpoint not active")
+        return
+
+    log.debug(f"Sending {data} to {app.command_endpoint.name}")
     try:
-        with open(STORAGE_USER_CONFIG, "r") as config_file:
-            config = config_file.read()
+        #OG
+        #resp = await app.command_endpoint.send(jsondata=data, ws=websocket)
+        #qad
+        #adds client hostname
+        data = {"hostname": app.connmgr.get_client_hostname(websocket), **data}
+        resp = await app.command_endpoint.send(jsondata=data, ws=websocket)
+        if resp is not None:
+            resp = app.command_endpoint.parse_response(resp)
+            log.debug(f"Got response {resp} from endpoint")
+            app.connmgr.send(websocket, resp)
+    except CommandEndpointTimeoutException as e:
+        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint timed out")
+        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
+        app.connmgr.send(websocket, command_endpoint_response.model_dump_json())
+        log.error(f"WAS Command Endpoint timed out: {e}")
+    except CommandEndpointRuntimeException as e:
+        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint unreachable")
+        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
+        app.connmgr.send(websocket, command_endpoint_response.model_dump_json())
+        log.error(f"WAS Command Endpoint unreachable: {e}")
     except Exception as e:
-        log.error(f"Failed to get config: {e}")
-    finally:
-        config_file.close()
-        return config
+        log.error(f"unhandled exception in command endpoint: {e}")
 
 
 @app.get("/", response_class=RedirectResponse)
@@ -143,7 +202,9 @@ app.include_router(config.router)
 app.include_router(info.router)
 app.include_router(ota.router)
 app.include_router(release.router)
+app.include_router(rollout.router)
 app.include_router(status.router)
+app.include_router(tts.router)
 
 
 # WebSockets with params return 403 when done with APIRouter
@@ -163,19 +224,9 @@ async def websocket_endpoint(
 
             # latency sensitive so handle first
             if "wake_start" in msg:
-                global wake_session
-                if wake_session is not None:
-                    if wake_session.done:
-                        del wake_session
-                        wake_session = WakeSession()
-                        asyncio.create_task(wake_session.cleanup())
-                else:
-                    wake_session = WakeSession()
-                    asyncio.create_task(wake_session.cleanup())
-
                 if "wake_volume" in msg["wake_start"]:
                     wake_event = WakeEvent(websocket, msg["wake_start"]["wake_volume"])
-                    wake_session.add_event(wake_event)
+                    app.wake_arbiter.add_event(wake_event)
 
             elif "wake_end" in msg:
                 pass
@@ -185,35 +236,13 @@ async def websocket_endpoint(
 
             elif "cmd" in msg:
                 if msg["cmd"] == "endpoint":
-                    if app.command_endpoint is not None:
-                        log.debug(f"Sending {msg['data']} to {app.command_endpoint.name}")
-                        try:
-                            #OG
-                            #resp = app.command_endpoint.send(jsondata=msg["data"], ws=websocket)
-                            #qad
-                            #adds client hostname
-                            data = {"hostname": app.connmgr.get_client_hostname(websocket), **msg["data"]}
-                            resp = app.command_endpoint.send(jsondata=data, ws=websocket)
-                            if resp is not None:
-                                resp = app.command_endpoint.parse_response(resp)
-                                log.debug(f"Got response {resp} from endpoint")
-                                # HomeAssistantWebSocketEndpoint sends message via callback
-                                if resp is not None:
-                                    asyncio.ensure_future(websocket.send_text(resp))
-                        except CommandEndpointRuntimeException as e:
-                            command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint unreachable")
-                            command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
-                            asyncio.ensure_future(websocket.send_text(command_endpoint_response.model_dump_json()))
-                            log.error(f"WAS Command Endpoint unreachable: {e}")
-
-                    else:
-                        command_endpoint_result = CommandEndpointResult(speech="WAS Command Endpoint not active")
-                        command_endpoint_response = CommandEndpointResponse(result=command_endpoint_result)
-                        asyncio.ensure_future(websocket.send_text(command_endpoint_response.model_dump_json()))
-                        log.error("WAS Command Endpoint not active")
+                    # run the command in its own task so a slow endpoint only delays this command
+                    task = asyncio.create_task(send_command_endpoint(websocket, msg["data"]))
+                    command_tasks.add(task)
+                    task.add_done_callback(command_tasks.discard)
 
                 elif msg["cmd"] == "get_config":
-                    asyncio.ensure_future(websocket.send_text(build_msg(get_config_ws(), "config")))
+                    app.connmgr.send(websocket, get_config_msg())
 
             elif "goodbye" in msg:
                 app.connmgr.disconnect(websocket)
@@ -227,6 +256,11 @@ async def websocket_endpoint(
                 if "mac_addr" in msg["hello"]:
                     mac_addr = hex_mac(msg["hello"]["mac_addr"])
                     app.connmgr.update_client(websocket, "mac_addr", mac_addr)
+                    app.connmgr.update_client(websocket, "zone", get_device_zone(mac_addr))
+                    # deliver notifications queued while the device was offline
+                    app.notify_queue.wakeup(mac_addr)
+                    # a device reconnecting after an OTA reports its new version in the user agent
+                    app.rollout_manager.on_hello(mac_addr, app.connmgr.get_client_by_ws(websocket))
 
     except WebSocketDisconnect:
         app.connmgr.disconnect(websocket)
@@ -234,3 +268,4 @@ async def websocket_endpoint(
         app.connmgr.disconnect(websocket)
     except Exception as e:
         log.error(f"unhandled exception in WebSocket route: {e}")
+        app.connmgr.disconnect(websocket)
@@ -1,12 +1,12 @@
 import os
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from logging import getLogger
 from typing import Literal
 from pydantic import BaseModel, Field
 
 from ..const import DIR_ASSET
+from ..internal.transfer import send_file
 from ..internal.was import get_mime_type, is_safe_path
 
 
@@ -24,7 +24,7 @@ class GetAsset(BaseModel):
 
 
 @router.get("/asset")
-async def api_get_asset(asset: GetAsset = Depends()):
+async def api_get_asset(request: Request, asset: GetAsset = Depends()):
     log.debug("API GET ASSET: Request")
     asset_file = f"{DIR_ASSET}/{asset.type}/{asset.asset}"
     log.debug(f"asset file: {asset_file}")
@@ -40,10 +40,10 @@ async def api_get_asset(asset: GetAsset = Depends()):
 
     # Return image and other types
     if asset.type == "image" or asset.type == "other":
-        return FileResponse(asset_file, media_type=magic_mime_type)
+        return await send_file(request, request.app.transfer_limiter, asset_file, magic_mime_type)
 
     # Only support audio formats supported by Willow
     if magic_mime_type == "audio/flac" or magic_mime_type == "audio/x-wav":
-        return FileResponse(asset_file, media_type=magic_mime_type)
+        return await send_file(request, request.app.transfer_limiter, asset_file, magic_mime_type)
     else:
         raise HTTPException(status_code=404, detail="Audio Asset wrong file format")
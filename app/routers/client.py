@@ -3,12 +3,12 @@ import json
 from logging import getLogger
 from typing import Literal
 
-from fastapi import APIRouter, Depends, Query, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
 from ..const import STORAGE_USER_CLIENT_CONFIG
-from ..internal.was import device_command, get_devices, warm_tts
+from ..internal.was import device_command, get_devices, save_json_to_file
 
 
 log = getLogger("WAS")
@@ -41,7 +41,8 @@ async def api_get_client(request: Request):
                 'ip': ws.client.host,
                 'port': ws.client.port,
                 'version': version,
-                'label': labels[client.mac_addr]
+                'label': labels[client.mac_addr],
+                'zone': client.zone,
             })
             macs.append(client.mac_addr)
 
@@ -56,7 +57,7 @@ async def api_get_client(request: Request):
 
 
 class PostClient(BaseModel):
-    action: Literal['restart', 'update', 'config', 'identify', 'notify'] = Field(
+    action: Literal['restart', 'update', 'config', 'identify', 'notify', 'notify_batch'] = Field(
         Query(..., description='Client action')
     )
 
@@ -68,13 +69,11 @@ async def api_post_client(request: Request, device: PostClient = Depends()):
 
     if device.action == "update":
         msg = json.dumps({'cmd': 'ota_start', 'ota_url': data["ota_url"]})
-        try:
-            ws = request.app.connmgr.get_client_by_hostname(data["hostname"])
-            await ws.send_text(msg)
-        except Exception as e:
-            log.error(f"Failed to trigger OTA ({e})")
-        finally:
-            return
+        hostname = data.get("hostname")
+        ws = request.app.connmgr.get_client_by_hostname(hostname)
+        if not request.app.connmgr.send(ws, msg):
+            log.error(f"Failed to trigger OTA ({hostname} not connected)")
+        return
     elif device.action == "config":
         devices = get_devices()
         new = True
@@ -88,13 +87,24 @@ async def api_post_client(request: Request, device: PostClient = Depends()):
         if new and len(data['mac_addr']) > 0:
             devices.append(data)
 
-        with open(STORAGE_USER_CLIENT_CONFIG, "w") as devices_file:
-            json.dump(devices, devices_file)
-        devices_file.close()
-    elif device.action == 'notify':
-        log.debug(f"received notify command on API: {data}")
-        warm_tts(data["data"])
-        request.app.notify_queue.add(data)
+        await save_json_to_file(STORAGE_USER_CLIENT_CONFIG, json.dumps(devices))
+
+        # move a connected device to its new wake zone right away
+        ws = request.app.connmgr.get_ws_by_mac(data['mac_addr'])
+        if ws is not None:
+            request.app.connmgr.update_client(ws, "zone", data.get("zone") or None)
+    elif device.action == 'notify' or device.action == 'notify_batch':
+        log.debug(f"received {device.action} command on API: {data}")
+        # notify_batch takes a list of notify messages, each with its own target and time
+        try:
+            msgs = request.app.notify_queue.validate(data if device.action == 'notify_batch' else [data])
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=json.loads(e.json()))
+
+        # fetch TTS audio once into the WAS cache and point the devices at it
+        await request.app.tts_cache.prepare(msgs)
+        results = request.app.notify_queue.add_batch(msgs)
+        return JSONResponse(content=results if device.action == 'notify_batch' else results[0])
     else:
         # Catch all assuming anything else is a device command
         return await device_command(request.app.connmgr, data, device.action)
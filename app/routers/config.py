@@ -1,3 +1,5 @@
+import asyncio
+
 from logging import getLogger
 from re import sub
 from typing import Literal, Optional
@@ -5,13 +7,15 @@ from typing import Literal, Optional
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
-from requests import get
 
 from ..const import URL_WILLOW_CONFIG
 from ..internal.command_endpoints.main import init_command_endpoint
+from ..internal.multinet import get_entity_names, multinet_generator
+from ..internal.upstream import upstream_cache
 from ..internal.was import (
     construct_url,
     get_config,
+    get_ha_entities,
     get_multinet,
     get_nvs,
     get_tz_config,
@@ -24,26 +28,31 @@ from ..internal.was import (
 
 log = getLogger("WAS")
 router = APIRouter(prefix="/api")
+reinit_tasks = set()
 
 
 class GetConfig(BaseModel):
-    type: Literal['config', 'nvs', 'ha_url', 'ha_token', 'multinet', 'was', 'tz'] = Field(
+    type: Literal['config', 'nvs', 'ha_commands', 'ha_entities', 'ha_url', 'ha_token', 'multinet', 'was', 'tz'] = Field(
         Query(..., description='Configuration type')
     )
     default: Optional[bool] = False
 
 
 @router.get("/config")
-async def api_get_config(config: GetConfig = Depends()):
+async def api_get_config(request: Request, config: GetConfig = Depends()):
     log.debug('API GET CONFIG: Request')
     # TZ is special
     if config.type == "tz":
-        config = get_tz_config(refresh=config.default)
+        config = await get_tz_config(refresh=config.default)
         return JSONResponse(content=config)
 
     # Otherwise handle other config types
     if config.default:
-        default_config = get(f"{URL_WILLOW_CONFIG}?type={config.type}").json()
+        try:
+            default_config = await upstream_cache.get(f"{URL_WILLOW_CONFIG}?type={config.type}")
+        except Exception as e:
+            log.error(f"failed to fetch default {config.type} config: {e}")
+            raise HTTPException(status_code=502, detail="Default config unavailable")
         if isinstance(default_config, dict):
             return default_config
         else:
@@ -58,11 +67,30 @@ async def api_get_config(config: GetConfig = Depends()):
             config["wis_tts_url"] = sub("[&?]text=", "", config["wis_tts_url_v2"])
             del config["wis_tts_url_v2"]
         return JSONResponse(content=config)
+    elif config.type in ["ha_commands", "ha_entities"]:
+        config_type = config.type
+        config = get_config()
+        if not all(key in config for key in ["hass_host", "hass_port", "hass_tls"]):
+            raise HTTPException(status_code=400, detail="Home Assistant not configured")
+        url = construct_url(config["hass_host"], config["hass_port"], config["hass_tls"])
+        state_cache = getattr(request.app, "ha_state_cache", None)
+        if state_cache is not None and state_cache.is_ready():
+            # the cache is updated on the event loop, so don't read it from another thread
+            entities = get_ha_entities(url, config.get("hass_token"), state_cache)
+        else:
+            entities = await asyncio.to_thread(get_ha_entities, url, config.get("hass_token"))
+        if config_type == "ha_commands" and isinstance(entities, list):
+            changes = multinet_generator.update(get_entity_names(entities))
+            log.debug(f"multinet: entity changes {changes}")
+            return JSONResponse(content=multinet_generator.commands())
+        return JSONResponse(content=entities)
     elif config.type == "ha_token":
         config = get_config()
         return PlainTextResponse(config["hass_token"])
     elif config.type == "ha_url":
         config = get_config()
+        if not all(key in config for key in ["hass_host", "hass_port", "hass_tls"]):
+            raise HTTPException(status_code=400, detail="Home Assistant not configured")
         url = construct_url(config["hass_host"], config["hass_port"], config["hass_tls"])
         return PlainTextResponse(url)
     elif config.type == "multinet":
@@ -73,6 +101,13 @@ async def api_get_config(config: GetConfig = Depends()):
         return JSONResponse(content=config)
 
 
+async def reinit_command_endpoint(app):
+    try:
+        await init_command_endpoint(app)
+    except Exception as e:
+        log.error(f"failed to initialize command endpoint, keeping the current one ({e})")
+
+
 class PostConfig(BaseModel):
     type: Literal['config', 'nvs', 'was'] = Field(Query(..., description='Configuration type'))
     apply: bool = Field(Query(..., description='Apply configuration to device'))
@@ -83,7 +118,10 @@ async def api_post_config(request: Request, config: PostConfig = Depends()):
     log.debug('API POST CONFIG: Request')
     if config.type == "config":
         await post_config(request, config.apply)
-        init_command_endpoint(request.app)
+        # (re)initialize in the background, devices keep using the current endpoint meanwhile
+        task = asyncio.create_task(reinit_command_endpoint(request.app))
+        reinit_tasks.add(task)
+        task.add_done_callback(reinit_tasks.discard)
     elif config.type == "nvs":
         await post_nvs(request, config.apply)
     elif config.type == "was":
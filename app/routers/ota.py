@@ -1,14 +1,15 @@
+import asyncio
+import httpx
 import os
 
 from logging import getLogger
-from pathlib import Path
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from pydantic import BaseModel, Field
-from requests import get
 
 from ..const import DIR_OTA
+from ..internal.ota import get_ota_checksum
+from ..internal.transfer import send_file
 from ..internal.was import get_releases_willow, is_safe_path
 
 
@@ -22,24 +23,37 @@ class GetOta(BaseModel):
 
 
 @router.get("/ota")
-async def api_get_ota(ota: GetOta = Depends()):
+async def api_get_ota(request: Request, ota: GetOta = Depends()):
     log.debug('API GET OTA: Request')
     ota_file = f"{DIR_OTA}/{ota.version}/{ota.platform}.bin"
     if not is_safe_path(DIR_OTA, ota_file):
         return
     if not os.path.isfile(ota_file):
-        releases = get_releases_willow()
+        releases = await get_releases_willow()
         for release in releases:
             if release["name"] == ota.version:
                 assets = release["assets"]
                 for asset in assets:
                     if asset["platform"] == ota.platform:
-                        Path(f"{DIR_OTA}/{ota.version}").mkdir(parents=True, exist_ok=True)
-                        r = get(asset["browser_download_url"])
-                        open(ota_file, 'wb').write(r.content)
+                        try:
+                            await request.app.ota_downloader.fetch(
+                                ota.version,
+                                ota.platform,
+                                asset["browser_download_url"],
+                                checksum=asset.get("sha256"),
+                                size=asset.get("size"),
+                            )
+                        except httpx.HTTPStatusError as e:
+                            raise HTTPException(status_code=e.response.status_code)
+                        except Exception as e:
+                            log.error(f"failed to download OTA {ota.version}/{ota.platform}: {e}")
+                            raise HTTPException(status_code=502, detail="OTA Download Failed")
 
     # If we still don't have the file return 404 - the platform and/or version doesn't exist
     if not os.path.isfile(ota_file):
         raise HTTPException(status_code=404, detail="OTA File Not Found")
 
-    return FileResponse(ota_file)
+    # the sha256 makes a strong ETag, so interrupted downloads can be resumed with If-Range
+    checksum = await asyncio.to_thread(get_ota_checksum, ota_file)
+    etag = f'"{checksum}"' if checksum is not None else None
+    return await send_file(request, request.app.transfer_limiter, ota_file, "application/octet-stream", etag)
@@ -1,13 +1,12 @@
+import httpx
 import os
 
 from logging import getLogger
-from pathlib import Path
 from typing import Literal
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
-from requests import get
 
 from ..const import DIR_OTA
 from ..internal.was import get_release_url, get_releases_willow, get_was_url, is_safe_path
@@ -24,7 +23,7 @@ class GetRelease(BaseModel):
 @router.get("/release")
 async def api_get_release(release: GetRelease = Depends()):
     log.debug('API GET RELEASE: Request')
-    releases = get_releases_willow()
+    releases = await get_releases_willow()
     if release.type == "willow":
         return releases
     elif release.type == "was":
@@ -64,24 +63,25 @@ async def api_post_release(request: Request, release: PostRelease = Depends()):
         # Check for safe path
         if not is_safe_path(DIR_OTA, dir):
             return
-        Path(dir).mkdir(parents=True, exist_ok=True)
 
         path = f"{dir}/{data['platform']}.bin"
-        if os.path.exists(path):
-            if os.path.getsize(path) == data['size']:
-                return
-            else:
-                os.remove(path)
-
-        resp = get(data['willow_url'])
-        if resp.status_code == 200:
-            with open(path, "wb") as fw:
-                fw.write(resp.content)
+        if os.path.exists(path) and os.path.getsize(path) == data['size']:
             return
-        else:
-            raise HTTPException(status_code=resp.status_code)
+
+        # an existing file of the wrong size is replaced once the download is complete
+        try:
+            await request.app.ota_downloader.fetch(data['version'], data['platform'], data['willow_url'],
+                                                   size=data['size'])
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=e.response.status_code)
+        except Exception as e:
+            log.error(f"failed to cache OTA {data['version']}/{data['platform']}: {e}")
+            raise HTTPException(status_code=502, detail="OTA Download Failed")
+        return
     elif release.action == "delete":
         data = await request.json()
         path = data['path']
         if is_safe_path(DIR_OTA, path):
             os.remove(path)
+            if os.path.exists(f"{path}.sha256"):
+                os.remove(f"{path}.sha256")
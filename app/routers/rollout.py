@@ -0,0 +1,50 @@
+import json
+
+from logging import getLogger
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field, ValidationError
+
+from ..internal.rollout import RolloutException, RolloutParams
+
+
+log = getLogger("WAS")
+router = APIRouter(
+    prefix="/api",
+)
+
+
+class PostRollout(BaseModel):
+    action: Literal['start', 'pause', 'resume', 'cancel'] = Field(Query(..., description='Rollout action'))
+
+
+@router.post("/rollout")
+async def api_post_rollout(request: Request, rollout: PostRollout = Depends()):
+    log.debug('API POST ROLLOUT: Request')
+    manager = request.app.rollout_manager
+
+    if rollout.action == "start":
+        data = await request.json()
+        try:
+            params = RolloutParams.model_validate(data)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=json.loads(e.json()))
+
+        try:
+            manager.start(params)
+        except RolloutException as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+    elif manager.rollout is None:
+        raise HTTPException(status_code=404, detail="No rollout")
+
+    elif rollout.action == "pause":
+        manager.rollout.pause()
+    elif rollout.action == "resume":
+        manager.rollout.resume()
+    elif rollout.action == "cancel":
+        manager.rollout.cancel()
+
+    return JSONResponse(content=manager.status())
@@ -16,7 +16,7 @@ router = APIRouter(
 
 
 class GetStatus(BaseModel):
-    type: Literal['asyncio_tasks', 'notify_queue'] = Field(Query(..., description='Status type'))
+    type: Literal['asyncio_tasks', 'command_endpoint', 'notify_queue', 'rollout', 'transfers'] = Field(Query(..., description='Status type'))
 
 
 @router.get("/status")
@@ -29,7 +29,18 @@ async def api_get_status(request: Request, status: GetStatus = Depends()):
         for task in tasks:
             res.append(f"{task.get_name()}: {task.get_coro()}")
 
+    elif status.type == "command_endpoint":
+        if request.app.command_endpoint is None:
+            return JSONResponse(None)
+        return JSONResponse(request.app.command_endpoint.status())
+
     elif status.type == "notify_queue":
-        return JSONResponse(request.app.notify_queue.model_dump(exclude={'connmgr', 'task'}))
+        return JSONResponse(request.app.notify_queue.model_dump(exclude={'connmgr', 'journal', 'task'}))
+
+    elif status.type == "rollout":
+        return JSONResponse(request.app.rollout_manager.status())
+
+    elif status.type == "transfers":
+        return JSONResponse(request.app.transfer_limiter.status())
 
     return JSONResponse(res)
@@ -0,0 +1,44 @@
+import asyncio
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from logging import getLogger
+from pydantic import BaseModel, Field
+
+
+log = getLogger("WAS")
+router = APIRouter(
+    prefix="/api",
+)
+
+TTS_CHUNK_SIZE = 64 * 1024
+
+
+class GetTts(BaseModel):
+    id: str = Field(Query(..., description="TTS cache ID"))
+
+
+@router.get("/tts")
+async def api_get_tts(request: Request, tts: GetTts = Depends()):
+    log.debug("API GET TTS: Request")
+    path, media_type = request.app.tts_cache.get(tts.id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="TTS Audio Not Found")
+
+    # the cache may evict the entry at any time, an open file survives its removal
+    try:
+        file = await asyncio.to_thread(open, path, "rb")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="TTS Audio Not Found")
+
+    size = os.fstat(file.fileno()).st_size
+
+    async def stream():
+        try:
+            while chunk := await asyncio.to_thread(file.read, TTS_CHUNK_SIZE):
+                yield chunk
+        finally:
+            file.close()
+
+    return StreamingResponse(stream(), media_type=media_type, headers={"Content-Length": str(size)})
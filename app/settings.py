@@ -1,10 +1,30 @@
 from functools import lru_cache
+from typing import Literal
 
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     was_version: str = "unknown"
+    # budget for a single voice command, including the fallback endpoint if there is one
+    command_endpoint_timeout: float = 30.0
+    # consecutive failures before the circuit opens, and how long before a probe is let through
+    command_endpoint_failure_threshold: int = 5
+    command_endpoint_reset_timeout: float = 30.0
+    # OTA and asset downloads, rates are in bytes per second with 0 meaning unlimited
+    # a client resuming a download may still hold a slot for the connection it gave up on
+    transfer_client_concurrency: int = 2
+    transfer_client_rate_limit: int = 0
+    transfer_concurrency: int = 8
+    transfer_rate_limit: int = 0
+    # downloads wait for a slot as long as the device stays connected, setting this answers those
+    # still waiting after that many seconds with a 503 and Retry-After, which Willow doesn't retry
+    transfer_wait_timeout: float = 0
+    tts_cache_size_mb: int = 256
+    # outbound WebSocket messages buffered per client before the slow client policy applies
+    ws_send_queue_size: int = 64
+    ws_send_timeout: float = 5.0
+    ws_slow_client_policy: Literal["disconnect", "drop"] = "disconnect"
 
 
 @lru_cache
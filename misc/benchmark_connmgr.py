@@ -0,0 +1,37 @@
+# Micro-benchmark for ConnMgr lookups, run from the repository root:
+#   python misc/benchmark_connmgr.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.internal.client import Client  # noqa: E402
+from app.internal.connmgr import ConnMgr  # noqa: E402
+
+
+LOOKUPS = 10000
+
+
+def populate(connmgr, count):
+    for i in range(count):
+        ws = object()
+        connmgr.connected_clients[ws] = Client("Willow/0.0.0")
+        connmgr.update_client(ws, "hostname", f"willow-{i:06x}")
+        connmgr.update_client(ws, "mac_addr", f"00:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}")
+
+
+for count in (10, 100, 1000, 10000):
+    connmgr = ConnMgr()
+    populate(connmgr, count)
+    # worst case for a linear scan: the most recently connected device
+    hostname = f"willow-{count - 1:06x}"
+    mac = connmgr.get_mac_by_hostname(hostname)
+
+    t_hostname = timeit.timeit(lambda: connmgr.get_client_by_hostname(hostname), number=LOOKUPS)
+    t_mac = timeit.timeit(lambda: connmgr.get_mac_by_hostname(hostname), number=LOOKUPS)
+    t_ws = timeit.timeit(lambda: connmgr.get_ws_by_mac(mac), number=LOOKUPS)
+
+    print(f"{count:>6} clients: get_client_by_hostname {t_hostname / LOOKUPS * 1e9:7.0f} ns, "
+          f"get_mac_by_hostname {t_mac / LOOKUPS * 1e9:7.0f} ns, "
+          f"get_ws_by_mac {t_ws / LOOKUPS * 1e9:7.0f} ns")
@@ -0,0 +1,85 @@
+# Benchmark for multinet command generation over a synthetic HA install, run from the repository root:
+#   python misc/benchmark_multinet.py
+import os
+import re
+import sys
+import time
+
+from num2words import num2words
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.internal.multinet import MultinetGenerator, get_entity_names  # noqa: E402
+
+
+ENTITIES = 5000
+ROOMS = ["kitchen", "living room", "bedroom", "office", "garage", "hallway", "bathroom", "attic"]
+DOMAINS = ["light", "switch", "fan", "input_boolean", "sensor"]
+
+
+def get_commands_for_entity_legacy(entity):
+    # the per-entity implementation this generator replaced
+    commands = []
+    pattern = r'[^A-Za-z- ]'
+
+    numbers = re.search(r'(\d{1,})', entity)
+    if numbers:
+        for number in numbers.groups():
+            entity = entity.replace(number, f" {num2words(int(number))} ")
+
+    entity = entity.replace('_', ' ')
+    entity = re.sub(pattern, '', entity)
+    entity = " ".join(entity.split())
+    entity = entity.upper()
+
+    on = f'TURN ON {entity}'
+    off = f'TURN OFF {entity}'
+
+    if len(off) < 63:
+        commands.extend([on, off])
+
+    return commands
+
+
+def synthetic_states(count):
+    states = []
+    for i in range(count):
+        domain = DOMAINS[i % len(DOMAINS)]
+        room = ROOMS[i % len(ROOMS)]
+        states.append({
+            "entity_id": f"{domain}.{room.replace(' ', '_')}_{i}",
+            # room and domain repeat every 40 entities, numbers stay in a realistic range
+            "attributes": {"friendly_name": f"{room.title()} {domain.replace('_', ' ')} {i // 40}"},
+        })
+    return states
+
+
+states = synthetic_states(ENTITIES)
+names = get_entity_names(states)
+
+start = time.perf_counter()
+for name in names.values():
+    get_commands_for_entity_legacy(name)
+t_legacy = time.perf_counter() - start
+
+generator = MultinetGenerator()
+start = time.perf_counter()
+generator.update(names)
+commands = generator.commands()
+t_full = time.perf_counter() - start
+
+# rename 1% of the entities, add and remove a few
+for i, state in enumerate(states[:ENTITIES // 100]):
+    state["attributes"]["friendly_name"] += " renamed"
+states = states[10:] + synthetic_states(ENTITIES + 10)[ENTITIES:]
+names = get_entity_names(states)
+
+start = time.perf_counter()
+changes = generator.update(names)
+generator.commands()
+t_incremental = time.perf_counter() - start
+
+print(f"{len(names)} entities, {len(commands)} commands, {generator.truncated} over the phrase limit")
+print(f"legacy per-entity: {t_legacy * 1000:7.1f} ms")
+print(f"full generation:   {t_full * 1000:7.1f} ms")
+print(f"incremental:       {t_incremental * 1000:7.1f} ms {changes}")